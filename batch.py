@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+"""
+Batch mode: many templates parsed and validated in parallel processes
+and created as a single load.
+"""
+
+import io
+import os
+import glob
+import time
+import contextlib
+import functools
+import parse as p
+import metrics
+import cache
+
+template_extensions = ('.xls', '.xlsx')
+
+
+def find_templates(pattern):
+    """
+    Returns the template files in the directory pattern, or matching the
+    glob pattern, sorted by name.  Spreadsheet lock files are ignored.
+    """
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*')
+    return sorted(path for path in glob.glob(pattern)
+                  if path.lower().endswith(template_extensions)
+                  and not os.path.basename(path).startswith('~$'))
+
+
+def _load(cache_dir, cache_size, root, path):
+    # runs in a worker process, the output is returned to be printed in
+    # template order by the parent
+    st = time.time()
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        try:
+            template_cache = None
+            if cache_dir is not None:
+                template_cache = cache.TemplateCache(cache_dir, cache_size)
+            resources = p.parse_template(path, template_cache)
+            error = None
+        except Exception as e:
+            resources = []
+            error = str(e)
+        failed = [i for i, r in enumerate(resources) if not r.isvalid()]
+
+    # keep the journal keys of sheets with the same name in different
+    # templates apart, including templates with the same name in
+    # different directories
+    name = os.path.relpath(os.path.abspath(path), root)
+    for r in resources:
+        r.sheet = '%s/%s' % (name, r.sheet)
+    return path, resources, failed, error, out.getvalue(), time.time() - st
+
+
+def load(pattern, processes=None, cache_dir=None,
+         cache_size=cache.default_max_size):
+    """
+    Parses and validates every template matching pattern using a pool of
+    processes, sharing the template cache in cache_dir if given.  Returns
+    all of the resources, those that failed validation and a dict of the
+    keys of the resources read from each template.
+    """
+    templates = find_templates(pattern)
+    print('Parsing %d templates' % len(templates))
+
+    resources = []
+    failed = []
+    by_template = {}
+    if len(templates) == 0:
+        return resources, failed, by_template
+
+    from concurrent.futures import ProcessPoolExecutor
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(t))
+                               for t in templates])
+    processes = min(processes or os.cpu_count() or 1, len(templates))
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for path, res, bad, error, output, elapsed in pool.map(
+                functools.partial(_load, cache_dir, cache_size, root),
+                templates):
+            metrics.record('parse_template', elapsed,
+                           'error' if error else 'ok', template=path)
+            if error is not None:
+                print('  %s: could not be read: %s' % (path, error))
+            else:
+                print('  %s: %d resources, %d NOT valid'
+                      % (path, len(res), len(bad)))
+            by_template[path] = [r.sheet for r in res]
+            resources.extend(res)
+            failed.extend(res[i] for i in bad)
+
+    print('  %d resources are valid' % (len(resources) - len(failed)))
+    print('  %d resources are NOT valid' % len(failed))
+    print('  %d bytes to upload' % sum(r.upload_bytes for r in resources))
+    if len(failed) > 0:
+        print('Some components of the templates failed validation.')
+        for f in failed:
+            print('\nResource: %s (%s)' % (f.title, f.sheet))
+            print(50*'-')
+            f.display_errors()
+        print('\n')
+    return resources, failed, by_template
+
+
+def report(by_template, errors, skipped=()):
+    """
+    Prints the number of resources created from each template.  errors
+    is the error dict returned by create.create_many and skipped the
+    resources that were not attempted.
+    """
+    failed_keys = set(d['key'] for d in errors.values())
+    skipped = set(r.sheet for r in skipped)
+    print('\n' + 50*'-')
+    print('Batch Summary')
+    print(50*'-')
+    print('  %-36s %8s %8s %8s' % ('template', 'created', 'failed',
+                                   'skipped'))
+    for path, keys in by_template.items():
+        nskipped = sum(1 for k in keys if k in skipped)
+        nfailed = sum(1 for k in keys if k in failed_keys)
+        print('  %-36s %8d %8d %8d'
+              % (os.path.basename(path)[:36],
+                 len(keys) - nskipped - nfailed, nfailed, nskipped))
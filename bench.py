@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+"""
+Throughput benchmark for create.create_many, run against the local
+stand-in server in fakeserver.py with a synthetic manifest.
+"""
+
+import os
+import io
+import csv
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+import parse as p
+import create
+import connect
+import policy
+import manifest
+import upload
+import metrics
+from fakeserver import FakeHydroShare
+from hs_restclient import HydroShareAuthBasic
+
+
+# steps that only wait for the resource to be created
+metadata_steps = ('sharing', 'shareable', 'scimeta')
+
+
+def metadata_wait(path):
+    """
+    Returns the time from the creation of each resource to the end of
+    each of its metadata steps, read from a metrics log.  This includes
+    the time spent queued behind other steps and requests.
+    """
+    events = []
+    with open(path) as f:
+        for line in f:
+            events.append(json.loads(line))
+    created = dict((e['resource'], e['time']) for e in events
+                   if e['step'] == 'create')
+    return [e['time'] - created[e['resource']] for e in events
+            if e['step'] in metadata_steps and e['resource'] in created]
+
+
+def percentile(values, pct):
+    if len(values) == 0:
+        return 0.
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100. *
+                                                  (len(values) - 1))))]
+
+
+def write_dataset(directory, nresources, nfiles, file_size):
+    """
+    Writes nfiles files of file_size bytes per resource and a manifest
+    describing them.  Returns the manifest directory.
+    """
+    data = os.path.join(directory, 'data')
+    os.makedirs(data)
+    mdir = os.path.join(directory, 'manifest')
+    os.makedirs(mdir)
+
+    with open(os.path.join(mdir, 'resources.csv'), 'w', newline='') as r, \
+            open(os.path.join(mdir, 'files.csv'), 'w', newline='') as f, \
+            open(os.path.join(mdir, 'authors.csv'), 'w', newline='') as a:
+        resources = csv.writer(r)
+        files = csv.writer(f)
+        authors = csv.writer(a)
+        resources.writerow(['resource_key', 'title', 'abstract', 'keywords',
+                            'type', 'sharing_status', 'shareable'])
+        files.writerow(['resource_key', 'uid', 'path', 'type', 'unzip'])
+        authors.writerow(['resource_key', 'name', 'organization', 'email'])
+        for i in range(nresources):
+            key = 'r%06d' % i
+            resources.writerow([key, 'benchmark resource %d' % i,
+                                'synthetic benchmark resource',
+                                'benchmark,synthetic', 'CompositeResource',
+                                'public', 'false'])
+            authors.writerow([key, 'Bench User', 'CUAHSI',
+                              'bench@example.com'])
+            for j in range(nfiles):
+                path = os.path.join(data, '%s-%d.dat' % (key, j))
+                with open(path, 'wb') as out:
+                    out.write(os.urandom(file_size))
+                files.writerow([key, j + 1, path, '', 0])
+    return mdir
+
+
+def run(args):
+    tmpdir = tempfile.mkdtemp(prefix='hs-bench-')
+    try:
+        mdir = write_dataset(tmpdir, args.resources, args.files,
+                             args.file_size * 1024)
+
+        server = FakeHydroShare(latency=args.latency,
+                                bandwidth=args.bandwidth * 2**20,
+                                error_rate=args.error_rate)
+        port = server.start()
+        hs = connect.PooledHydroShare(hostname='127.0.0.1', port=port,
+                                      use_https=False,
+                                      auth=HydroShareAuthBasic('bench',
+                                                               'bench'),
+                                      pool_size=args.max_inflight)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            resources = list(manifest.iter_manifest(mdir))
+            p.validate(resources)
+        nbytes = sum(r.upload_bytes for r in resources)
+
+        upload.set_bandwidth(args.max_bandwidth * 2**20, report_interval=0)
+        log = os.path.join(tmpdir, 'metrics.jsonl')
+        metrics.open_log(log)
+        st = time.time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            created, errors = create.create_many(
+                hs, resources, workers=args.workers,
+                max_inflight=args.max_inflight,
+                step_workers=args.step_workers,
+                request_policy=policy.RequestPolicy(rate=args.rate,
+                                                    backoff=0.1),
+                bundle_threshold=args.bundle_threshold * 1024)
+        elapsed = time.time() - st
+        metrics.close_log()
+        waits = metadata_wait(log)
+        server.shutdown()
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    result = dict(time=time.time(),
+                  label=args.label,
+                  config={k: v for k, v in vars(args).items()
+                          if k not in ('output', 'label')},
+                  created=len(created),
+                  failed=len(errors),
+                  elapsed=elapsed,
+                  resources_per_min=60 * len(created) / elapsed,
+                  bytes_per_sec=nbytes / elapsed,
+                  metadata_p95=percentile([t for name, s in
+                                           server.stats.items()
+                                           if name != 'upload'
+                                           for t in s['times']], 95),
+                  metadata_wait_p95=percentile(waits, 95),
+                  steps={name: dict(count=len(s['times']),
+                                    errors=s['errors'],
+                                    p50=percentile(s['times'], 50),
+                                    p95=percentile(s['times'], 95))
+                         for name, s in server.stats.items()})
+    return result
+
+
+def report(result):
+    print('\n' + 50*'-')
+    print('Benchmark Results %s' % (result['label'] or ''))
+    print(50*'-')
+    print('  resources created: %d (%d failed)' % (result['created'],
+                                                  result['failed']))
+    print('  elapsed time:      %.2f s' % result['elapsed'])
+    print('  resources/min:     %.1f' % result['resources_per_min'])
+    print('  upload rate:       %.2f MB/s'
+          % (result['bytes_per_sec'] / 2**20))
+    print('  other p95:         %.1f ms' % (1000 * result['metadata_p95']))
+    print('  metadata wait p95: %.1f ms'
+          % (1000 * result['metadata_wait_p95']))
+    print('\n  %-16s %8s %8s %10s %10s' % ('step', 'count', 'errors',
+                                           'p50 (ms)', 'p95 (ms)'))
+    for name, s in sorted(result['steps'].items()):
+        print('  %-16s %8d %8d %10.1f %10.1f'
+              % (name, s['count'], s['errors'], 1000 * s['p50'],
+                 1000 * s['p95']))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Bulk resource creation '
+                                     'throughput benchmark.')
+    parser.add_argument('-n', '--resources', type=int, default=50)
+    parser.add_argument('-f', '--files', type=int, default=5,
+                        help='files per resource')
+    parser.add_argument('--file-size', type=int, default=256,
+                        help='size of each file in KB')
+    parser.add_argument('-w', '--workers', type=int, default=4)
+    parser.add_argument('--step-workers', type=int, default=4)
+    parser.add_argument('--max-inflight', type=int, default=16)
+    parser.add_argument('--rate', type=float, default=1000)
+    parser.add_argument('--bundle-threshold', type=int, default=0,
+                        help='bundle files smaller than this many KB')
+    parser.add_argument('--max-bandwidth', type=float, default=0,
+                        help='client side limit for all uploads together '
+                        'in MB/s (0 is unlimited)')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='mean server latency per request in seconds')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='server bandwidth per request in MB/s')
+    parser.add_argument('--error-rate', type=float, default=0.,
+                        help='fraction of requests failing with 503')
+    parser.add_argument('--label', default='',
+                        help='name recorded with the results')
+    parser.add_argument('-o', '--output',
+                        help='append the results as a JSON line to this '
+                        'file, for comparison across runs')
+    args = parser.parse_args()
+
+    result = run(args)
+    report(result)
+    if args.output is not None:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(result) + '\n')
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+"""
+Start-up cost of the tool: the time to import each module in a fresh
+interpreter, the heavy third party packages each one pulls in, and the
+wall time of the commands that do not connect to HydroShare.  Each
+measurement is the best of several runs.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import synthetic
+
+modules = ['bulk_upload', 'parse', 'manifest', 'plan', 'create', 'sync',
+           'rollback', 'batch', 'connect']
+
+# packages that dominate start-up and are only needed by some commands
+heavy = ['xlrd', 'requests', 'hs_restclient', 'tabulate', 'multiprocessing']
+
+_probe = '''
+import sys, time, json
+st = time.perf_counter()
+import %s
+elapsed = time.perf_counter() - st
+print(json.dumps(dict(elapsed=elapsed,
+                      loaded=[m for m in %r if m in sys.modules])))
+'''
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def import_time(module, runs):
+    best = None
+    for i in range(runs):
+        out = subprocess.check_output([sys.executable, '-c',
+                                       _probe % (module, heavy)], cwd=here)
+        result = json.loads(out.decode().splitlines()[-1])
+        if best is None or result['elapsed'] < best['elapsed']:
+            best = result
+    best['module'] = module
+    return best
+
+
+def command_time(args, runs):
+    best = None
+    for i in range(runs):
+        st = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(here, 'bulk_upload.py')]
+                       + args, cwd=here, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        elapsed = time.perf_counter() - st
+        best = elapsed if best is None else min(best, elapsed)
+    return dict(command=' '.join(args), elapsed=best)
+
+
+def run(args):
+    results = []
+    print('Import time')
+    for module in args.modules:
+        r = import_time(module, args.runs)
+        results.append(r)
+        print('  %-12s %8.1f ms  %s' % (r['module'], r['elapsed'] * 1000,
+                                        ', '.join(r['loaded']) or '-'),
+              flush=True)
+
+    tmpdir = tempfile.mkdtemp(prefix='hs-bench-import-')
+    try:
+        data = os.path.join(tmpdir, 'data.csv')
+        with open(data, 'w') as f:
+            f.write('x,y\n1,2\n')
+        template = os.path.join(tmpdir, 'template.xls')
+        synthetic.write_template(template, args.sheets, 3, files=[data])
+
+        print('Command wall time (%d sheets)' % args.sheets)
+        for command in (['--validate', '-t', template],
+                        ['--plan', '-t', template]):
+            r = command_time(command, args.runs)
+            results.append(r)
+            print('  %-12s %8.1f ms' % (command[0], r['elapsed'] * 1000),
+                  flush=True)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Import and start-up time '
+                                     'of the bulk upload tool.')
+    parser.add_argument('--modules', nargs='+', default=modules)
+    parser.add_argument('-n', '--runs', type=int, default=5,
+                        help='runs per measurement, the best is reported')
+    parser.add_argument('--sheets', type=int, default=10,
+                        help='sheets in the template used to time commands')
+    parser.add_argument('-o', '--output',
+                        help='append the results as JSON lines to this file')
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.output is not None:
+        with open(args.output, 'a') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+"""
+Peak memory of create.create_many as the number of resources grows,
+run against the local stand-in server in a separate process.  Each
+resource count is measured in a fresh process so that peaks of earlier
+runs do not carry over.
+
+  list    every resource is read into a list and kept until the end, as
+          the tool used to
+  drain   the list is handed to create_many with create.drain, freeing
+          resources as they finish
+  stream  resources are read from the manifest as they are created
+"""
+
+import io
+import os
+import sys
+import csv
+import json
+import time
+import socket
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+import subprocess
+import parse as p
+import create
+import connect
+import manifest
+import policy
+from hs_restclient import HydroShareAuthBasic
+
+modes = ['list', 'drain', 'stream']
+
+
+def write_manifest(directory, nresources, nfiles=10):
+    """
+    Writes a manifest of nresources resources sharing a small set of
+    data files.
+    """
+    paths = []
+    for i in range(nfiles):
+        path = os.path.join(directory, 'data-%d.csv' % i)
+        with open(path, 'w') as f:
+            f.write('x,y\n' + '%d,%d\n' % (i, i) * 16)
+        paths.append(path)
+
+    with open(os.path.join(directory, 'resources.csv'), 'w',
+              newline='') as r, \
+            open(os.path.join(directory, 'files.csv'), 'w', newline='') as f, \
+            open(os.path.join(directory, 'authors.csv'), 'w',
+                 newline='') as a:
+        resources = csv.writer(r)
+        files = csv.writer(f)
+        authors = csv.writer(a)
+        resources.writerow(['resource_key', 'title', 'abstract', 'keywords',
+                            'type', 'sharing_status', 'shareable'])
+        files.writerow(['resource_key', 'uid', 'path', 'type', 'unzip'])
+        authors.writerow(['resource_key', 'name', 'organization', 'email'])
+        for i in range(nresources):
+            key = 'r%07d' % i
+            resources.writerow([key, 'memory benchmark resource %d' % i,
+                                'synthetic resource ' * 20,
+                                'benchmark,memory,synthetic',
+                                'CompositeResource', 'private', 'false'])
+            files.writerow([key, 1, paths[i % nfiles], '', 0])
+            for j in range(2):
+                authors.writerow([key, 'Author %d' % j, 'CUAHSI',
+                                  'author%d@example.com' % j])
+
+
+def peak_rss():
+    # the stdlib resource module is shadowed by resource.py
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def measure(args):
+    tmpdir = tempfile.mkdtemp(prefix='hs-bench-memory-')
+    try:
+        write_manifest(tmpdir, args.resources)
+        hs = connect.PooledHydroShare(hostname='127.0.0.1', port=args.port,
+                                      use_https=False,
+                                      auth=HydroShareAuthBasic('bench',
+                                                               'bench'),
+                                      pool_size=args.workers)
+
+        tracemalloc.start()
+        st = time.time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            if args.mode == 'stream':
+                resources = p.iter_valid(manifest.iter_manifest(tmpdir), [])
+            else:
+                resources = list(manifest.iter_manifest(tmpdir))
+                p.validate(resources)
+                if args.mode == 'drain':
+                    resources = create.drain(resources)
+            created, errors = create.create_many(
+                hs, resources, workers=args.workers,
+                max_inflight=args.workers,
+                request_policy=policy.RequestPolicy(rate=100000))
+        elapsed = time.time() - st
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return dict(mode=args.mode, resources=args.resources,
+                created=len(created), failed=len(errors), elapsed=elapsed,
+                peak_traced=peak, peak_rss=peak_rss())
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def run(args):
+    port = _free_port()
+    here = os.path.dirname(os.path.abspath(__file__))
+    server = subprocess.Popen([sys.executable,
+                               os.path.join(here, 'fakeserver.py'),
+                               '-p', str(port)], stdout=subprocess.DEVNULL)
+    try:
+        time.sleep(1)
+        results = []
+        for mode in args.modes:
+            for n in args.resources:
+                out = subprocess.check_output(
+                    [sys.executable, os.path.abspath(__file__), '--child',
+                     '--mode', mode, '-n', str(n), '--port', str(port),
+                     '-w', str(args.workers)])
+                results.append(json.loads(out.decode().splitlines()[-1]))
+                report(results[-1])
+        return results
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def report(result):
+    print('  %-7s %8d resources  %7.1f s  peak traced %8.1f MB  '
+          'peak RSS %8.1f MB'
+          % (result['mode'], result['resources'], result['elapsed'],
+             result['peak_traced'] / 2.**20, result['peak_rss'] / 2.**20),
+          flush=True)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Peak memory of bulk '
+                                     'resource creation.')
+    parser.add_argument('-n', '--resources', type=int, nargs='+',
+                        default=[500, 1000, 2000])
+    parser.add_argument('--modes', nargs='+', choices=modes, default=modes)
+    parser.add_argument('-w', '--workers', type=int, default=8)
+    parser.add_argument('-o', '--output',
+                        help='append the results as JSON lines to this file')
+    parser.add_argument('--child', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--mode', choices=modes, help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        args.resources = args.resources[0]
+        print(json.dumps(measure(args)))
+        sys.exit()
+
+    results = run(args)
+    if args.output is not None:
+        with open(args.output, 'a') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks template parsing on synthetic workbooks, comparing the
+row-indexed parser against the cell-by-cell parser it replaced.
+"""
+
+import os
+import time
+import xlrd
+import argparse
+import tempfile
+from datetime import datetime as dt
+import parse as p
+import synthetic
+
+
+def legacy_get_value(sheet, row, col):
+    value_type = sheet.cell_type(rowx=row, colx=col)
+    value = sheet.cell_value(rowx=row, colx=col)
+    if value_type == xlrd.XL_CELL_DATE:
+        return dt(*xlrd.xldate_as_tuple(value, p.datemode)).isoformat()
+    else:
+        return value
+
+
+def legacy_section_ranges(sheet):
+    # probe one cell at a time until reading past the last row fails
+    row = 0
+    sections = {}
+    current_section = None
+    while 1:
+        try:
+            value = legacy_get_value(sheet, row, 0)
+        except Exception:
+            sections[current_section]['end'] = row
+            break
+        if value in p.valid_sections:
+            sections[value] = dict(start=row+2, end=None)
+            if current_section is not None:
+                sections[current_section]['end'] = row-2
+            current_section = value
+        row += 1
+    return sections
+
+
+def legacy_parse_sheet(sheet):
+    # the body of the sheet loop of the original parse_template, which
+    # read plain cell values and converted only the date and custom
+    # value cells; building the Resource is left out
+    sections = legacy_section_ranges(sheet)
+
+    rs = sections['General Metadata']['start']
+    resource_title = sheet.cell_value(rowx=rs, colx=1)
+    abstract = sheet.cell_value(rowx=rs+1, colx=1)
+    keywords = [k.strip() for k in
+                sheet.cell_value(rowx=rs+2, colx=1).split()
+                if k != '']
+    resource_type = sheet.cell_value(rowx=rs+3, colx=1)
+    sharing_status = sheet.cell_value(rowx=rs+4, colx=1)
+    shareable = sheet.cell_value(rowx=rs+5, colx=1)
+
+    files = []
+    rs = sections['Resource Content']['start']
+    re = sections['Resource Content']['end']
+    for row in range(rs, re):
+        uid = sheet.cell_value(rowx=row, colx=0)
+        path = sheet.cell_value(rowx=row, colx=1)
+        type = sheet.cell_value(rowx=row, colx=7)
+        unzip = sheet.cell_value(rowx=row, colx=9)
+        if path != '':
+            files.append(dict(uid=uid, path=path, type=type, unzip=unzip))
+
+    file_meta = []
+    rs = sections['File Metadata']['start']
+    re = sections['File Metadata']['end']
+    for row in range(rs, re):
+        uid = sheet.cell_value(rowx=row, colx=1)
+        title = sheet.cell_value(rowx=row, colx=5)
+        start_dt = legacy_get_value(sheet, row, 7)
+        end_dt = legacy_get_value(sheet, row, 8)
+        location = sheet.cell_value(rowx=row, colx=9)
+        coverage = sheet.cell_value(rowx=row, colx=11)
+        spatial_def = sheet.cell_value(rowx=row, colx=13)
+        if uid != '':
+            file_meta.append(dict(uid=uid, title=title, start_dt=start_dt,
+                                  end_dt=end_dt, location=location,
+                                  coverage=coverage, spatial_def=spatial_def))
+
+    authors = []
+    rs = sections['Science Metadata']['start']
+    re = sections['Science Metadata']['end']
+    for row in range(rs, re):
+        name = sheet.cell_value(rowx=row, colx=1)
+        org = sheet.cell_value(rowx=row, colx=3)
+        email = sheet.cell_value(rowx=row, colx=5)
+        addr = sheet.cell_value(rowx=row, colx=7)
+        phone = sheet.cell_value(rowx=row, colx=11)
+        if name != '':
+            authors.append(dict(name=name, organization=org, email=email,
+                                address=addr, phone=phone))
+
+    custom_metadata = {}
+    rs = sections['Resource Metadata']['start']
+    re = sections['Resource Metadata']['end']
+    for row in range(rs, re):
+        key = sheet.cell_value(rowx=row, colx=1)
+        if key != '':
+            custom_metadata[key] = legacy_get_value(sheet, row, 3)
+
+    return (resource_title, abstract, keywords, resource_type, files,
+            sharing_status, shareable, authors, custom_metadata, file_meta)
+
+
+def time_parse(book, func, runs):
+    # best of several runs over the same open workbook
+    best = None
+    for i in range(runs):
+        st = time.perf_counter()
+        for j in range(book.nsheets):
+            sheet = book.sheet_by_index(j)
+            if sheet.name[0:2] != '__':
+                func(sheet)
+        elapsed = time.perf_counter() - st
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Template parsing '
+                                     'benchmark.')
+    parser.add_argument('--sheets', type=int, nargs='+',
+                        default=[100, 1000],
+                        help='numbers of resource sheets to benchmark')
+    parser.add_argument('--files', type=int, default=500,
+                        help='number of Resource Content rows per sheet')
+    parser.add_argument('-n', '--runs', type=int, default=5,
+                        help='runs per measurement, the best is reported')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='hs-bench-')
+    print('%8s %8s %12s %12s %8s' % ('sheets', 'files', 'legacy (s)',
+                                     'indexed (s)', 'speedup'))
+    for n in args.sheets:
+        path = os.path.join(tmpdir, 'template-%d.xls' % n)
+        synthetic.write_template(path, n, args.files)
+        book = xlrd.open_workbook(path)
+        p.datemode = book.datemode
+
+        legacy = time_parse(book, legacy_parse_sheet, args.runs)
+        indexed = time_parse(book, p.parse_sheet, args.runs)
+        print('%8d %8d %12.3f %12.3f %7.1fx' % (n, args.files, legacy,
+                                                indexed, legacy / indexed))
+        os.remove(path)
+    os.rmdir(tmpdir)
@@ -3,16 +3,24 @@
 
 import os
 import sys
-import xlrd
-import time
-import getpass
-from resource import Resource
-from datetime import datetime as dt
+import atexit
+import tempfile
+from journal import Journal
 import parse as p
 import argparse
-import connect
 import create
-import requests
+import manifest
+import dedupe
+import policy
+import upload
+import metrics
+import plan
+import batch
+import rollback
+import sync
+import compress
+import cache
+import catalog
 
 
 def __exit():
@@ -22,21 +30,70 @@ def __exit():
     sys.exit()
 
 
-def __auth_user(username, host='www.hydroshare.org', ssl_verify=True):
-    hs = connect.authenticate(username, host, 3, ssl_verify)
+def __finish(args):
+    if args.metrics is not None or args.prometheus is not None:
+        metrics.report()
+    if args.prometheus is not None:
+        metrics.write_prometheus(args.prometheus)
+    metrics.close_log()
+    __exit()
+
+
+def __auth_user(username, host='www.hydroshare.org', ssl_verify=True,
+                pool_size=None, client_id=None, client_secret=None):
+    # the HydroShare client is only loaded by commands that connect
+    import connect
+    if pool_size is None:
+        pool_size = connect.default_pool_size
+    hs = connect.authenticate(username, host, 3, ssl_verify, pool_size,
+                              client_id, client_secret)
     if hs:
         return hs
     else:
         __exit()
 
 
-def run_interactive():
+def __load_batch(args):
+    return batch.load(args.batch, args.processes,
+                      args.cache_dir if args.cache else None,
+                      args.cache_size * 2**20)
+
+
+def __read(args):
+    if args.manifest is not None:
+        return manifest.iter_manifest(args.manifest)
+    template_cache = None
+    if args.cache:
+        template_cache = cache.TemplateCache(args.cache_dir,
+                                             args.cache_size * 2**20)
+    return p.iter_template(args.template, template_cache)
+
+
+def __read_valid(args):
+    # batch.load validates the templates and prints the errors itself
+    if args.batch is not None:
+        resources, failed, by_template = __load_batch(args)
+        return resources, failed
+    resources = list(__read(args))
+    return resources, p.validate(resources)
+
+
+def __compressor(args):
+    # the pool of processes is only started once a file is compressed
+    if not args.compress:
+        return None
+    return compress.Compressor(
+        args.compress_processes,
+        max(args.compress_min_size, args.bundle_threshold) * 2**10)
+
+
+def run_interactive(pool_size=None):
 
     default_host = "www.hydroshare.org"
     host = input('Enter host address (default: www.hydroshare.org): ') or default_host
     username = input('Please enter username: ')
 
-    hs = __auth_user(username, host)
+    hs = __auth_user(username, host, pool_size=pool_size)
 
     template_exists = False
     while not template_exists:
@@ -54,31 +111,167 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='HydroShare bulk resource '
                                      'creator tool.')
     parser.add_argument('-t', '--template', help='bulk insert template file')
+    parser.add_argument('-m', '--manifest',
+                        help='directory of manifest tables to read instead '
+                        'of a template file')
+    parser.add_argument('-b', '--batch',
+                        help='directory or glob pattern of template files '
+                        'to create as a single load')
+    parser.add_argument('--processes', type=int,
+                        help='number of processes used to parse templates '
+                        'in batch mode (default: one per CPU)')
+    parser.add_argument('--cache', action='store_true',
+                        help='keep parsed and validated templates in a '
+                        'cache so unchanged sheets are not parsed again')
+    parser.add_argument('--cache-dir', default=cache.default_dir,
+                        help='directory of the template cache')
+    parser.add_argument('--cache-size', type=int,
+                        default=cache.default_max_size // 2**20,
+                        help='size in MB the template cache is kept under')
     parser.add_argument('-a', '--address', help='hydroshare host address')
     parser.add_argument('-u', '--user', help='hydroshare username')
     parser.add_argument('-s', '--no-ssl-verify', action='store_true',
                         help='turn off ssl verification')
+    parser.add_argument('--client-id',
+                        help='OAuth2 client id, authenticates with a token '
+                        'that is reused for the whole run')
+    parser.add_argument('--client-secret', help='OAuth2 client secret')
     parser.add_argument('-i', '--interactive-mode', action='store_true',
                         help='run in interactive mode')
     parser.add_argument('-d', '--debug', action='store_true',
                         help='run in debug mode to check the validity of '
                         'the template file')
+    parser.add_argument('--validate', action='store_true',
+                        help='only check that the resources are valid, '
+                        'without connecting to HydroShare; exits with '
+                        'status 1 if any are not')
+    parser.add_argument('--plan', action='store_true',
+                        help='estimate the API calls, bytes and time needed '
+                        'to create the resources without creating them')
+    parser.add_argument('--latency', type=float,
+                        help='seconds per request assumed by --plan '
+                        '(default %g)' % plan.default_latency)
+    parser.add_argument('--bandwidth', type=float,
+                        help='upload bandwidth in MB/s assumed by --plan '
+                        '(default %g)' % (plan.default_bandwidth / 2**20))
+    parser.add_argument('--calibrate',
+                        help='measure the latency and bandwidth used by '
+                        '--plan from the --metrics log of a previous run')
+    parser.add_argument('--order', choices=['sheet', 'longest-first'],
+                        default='sheet',
+                        help='order in which resources are created; '
+                        'longest-first shortens runs with several workers')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of resources to create in parallel')
+    parser.add_argument('--max-inflight', type=int,
+                        default=create.default_max_inflight,
+                        help='maximum number of simultaneous requests '
+                        'against the host, one of which is kept free of '
+                        'uploads')
+    parser.add_argument('--rate', type=float, default=20,
+                        help='maximum number of requests per second, reduced '
+                        'automatically while the server is overloaded')
+    parser.add_argument('--retries', type=int, default=5,
+                        help='number of times a request failing with a '
+                        'transient error is retried')
+    parser.add_argument('--step-workers', type=int, default=4,
+                        help='number of independent steps to run in '
+                        'parallel for each resource')
+    parser.add_argument('-j', '--journal',
+                        help='file in which to record the completed steps '
+                        'of this run')
+    parser.add_argument('-r', '--resume', action='store_true',
+                        help='resume the run recorded in the journal, '
+                        'skipping work that has already completed')
+    parser.add_argument('--chunk-size', type=int,
+                        default=upload.default_chunk_size // 2**20,
+                        help='size in MB of the chunks read from disk when '
+                        'uploading files')
+    parser.add_argument('--max-bandwidth', type=float,
+                        help='limit all uploads together to this many MB/s, '
+                        'shared fairly between files, leaving headroom for '
+                        'other requests')
+    parser.add_argument('--bundle-threshold', type=int, default=0,
+                        help='bundle files smaller than this many KB into '
+                        'a single zip upload per resource (0 disables)')
+    parser.add_argument('--compress', action='store_true',
+                        help='compress text files in the background and '
+                        'unzip them on the server, sending fewer bytes')
+    parser.add_argument('--compress-min-size', type=int,
+                        default=compress.default_min_size // 2**10,
+                        help='compress files of at least this many KB '
+                        '(files smaller than --bundle-threshold are bundled '
+                        'instead)')
+    parser.add_argument('--compress-processes', type=int,
+                        help='number of processes compressing files '
+                        '(default: one per CPU)')
+    parser.add_argument('--stream', action='store_true',
+                        help='start creating resources while the template '
+                        'is still being parsed, skipping invalid resources')
+    parser.add_argument('--dedupe', choices=['flag', 'skip'],
+                        help='find files whose content has already been '
+                        'uploaded and either report (flag) or not upload '
+                        'them (skip)')
+    parser.add_argument('--dedupe-index', default=dedupe.default_index,
+                        help='content hash index used by --dedupe')
+    parser.add_argument('--duplicates', choices=['flag', 'skip'],
+                        help='check the resources against a local catalog '
+                        'of the resources you already own and either '
+                        'report (flag) or not create (skip) those with the '
+                        'same title, type and keywords')
+    parser.add_argument('--catalog', default=catalog.default_catalog,
+                        help='catalog of existing resources used by '
+                        '--duplicates, refreshed with the resources created '
+                        'since the last run')
+    parser.add_argument('--full-refresh', action='store_true',
+                        help='fetch every existing resource into the '
+                        'catalog, dropping those that were deleted')
+    parser.add_argument('--sync', action='store_true',
+                        help='update existing resources to match the '
+                        'template, pushing only what differs; resource ids '
+                        'are taken from the --journal of the run that '
+                        'created them or the resource_id column of the '
+                        'manifest')
+    parser.add_argument('--diff', action='store_true',
+                        help='with --sync, only report the differences')
+    parser.add_argument('--rollback', choices=rollback.policies,
+                        default='prompt',
+                        help='what to do with resources that failed: ask '
+                        'for each one (prompt), delete or keep them all, or '
+                        'retry them once and delete those that fail again')
+    parser.add_argument('--metrics',
+                        help='write a JSON line timing event for every '
+                        'pipeline step to this file')
+    parser.add_argument('--prometheus',
+                        help='write the aggregated step timings to this '
+                        'file in the Prometheus text format when done')
 
     args = parser.parse_args()
-    template = args.template
+
+    if args.resume and args.journal is None:
+        print('\nERROR: --resume requires a --journal file')
+        sys.exit()
+    if args.journal is not None and not (args.resume or args.sync) and \
+            os.path.exists(args.journal):
+        print('\nERROR: journal %s already exists, use --resume to continue '
+              'that run or choose a different file' % args.journal)
+        sys.exit()
+    if args.metrics is not None:
+        metrics.open_log(args.metrics)
+    if args.max_bandwidth is not None:
+        upload.set_bandwidth(args.max_bandwidth * 2**20)
     
     # run interactive mode
     if args.interactive_mode:
         print('\n'+50 * '-')
         print('Interactive Mode')
         print(50 * '-' + '\n')
-        host, hs, template = run_interactive()
+        host, hs, args.template = run_interactive(args.max_inflight)
     elif args.debug:
         print('\n'+50 * '-')
         print('Running in Debug Mode')
         print(50 * '-' + '\n')
-        res = p.parse_template(template)
-        p.validate(res)
+        res, failed = __read_valid(args)
         print('\nTemplate Summary')
         for r in res:
             print(50*'-')
@@ -86,6 +279,44 @@ if __name__ == "__main__":
         print(50*'-')
         import pdb; pdb.set_trace()
         sys.exit()
+    elif args.validate:
+        res, failed = __read_valid(args)
+        sys.exit(1 if len(failed) > 0 else 0)
+    elif args.plan:
+        print('\n'+50 * '-')
+        print('Planning')
+        print(50 * '-' + '\n')
+        res, failed = __read_valid(args)
+        res = [r for r in res if r not in failed]
+        if args.dedupe == 'skip':
+            # the files a run would skip are not part of the plan
+            print('Checking for duplicate content')
+            dup = dedupe.check(res, dedupe.HashIndex(args.dedupe_index),
+                               skip=True)
+            print('  %d duplicate bytes found' % dup)
+        latency, bandwidth = None, None
+        if args.calibrate is not None:
+            latency, bandwidth = plan.calibrate(args.calibrate)
+        if args.latency is not None:
+            latency = args.latency
+        if args.bandwidth is not None:
+            bandwidth = args.bandwidth * 2**20
+        elif args.max_bandwidth is not None and \
+                (bandwidth is None or bandwidth > args.max_bandwidth * 2**20):
+            bandwidth = args.max_bandwidth * 2**20
+        compressor = __compressor(args)
+        result = plan.plan(res,
+                           workers=args.workers,
+                           step_workers=args.step_workers,
+                           latency=latency or plan.default_latency,
+                           bandwidth=bandwidth or plan.default_bandwidth,
+                           rate=args.rate,
+                           bundle_threshold=args.bundle_threshold * 2**10,
+                           compressor=compressor)
+        if compressor is not None:
+            compressor.shutdown()
+        plan.report(result)
+        sys.exit()
     else:
         print('\n'+50 * '-')
         print('Running in Standard Mode')
@@ -100,16 +331,50 @@ if __name__ == "__main__":
 #            import pdb; pdb.set_trace()
             ssl = False if args.no_ssl_verify else True
             if not ssl:
+                import requests
                 requests.packages.urllib3.disable_warnings()
-            hs = __auth_user(args.user, args.address, ssl)
+            hs = __auth_user(args.user, args.address, ssl,
+                             pool_size=args.max_inflight,
+                             client_id=args.client_id,
+                             client_secret=args.client_secret)
 
-    # parse template
-    resources = p.parse_template(template)
+    index = None
+    resumed = set()
+    if args.dedupe is not None:
+        index = dedupe.HashIndex(args.dedupe_index)
+        if args.resume:
+            # files already uploaded to the resources being resumed are
+            # not duplicates, their remaining steps still have to run
+            j = Journal(args.journal)
+            resumed = set(j.resources().values())
+            j.close()
 
-    # run template validation
-    failed = p.validate(resources)
+    failed = []
+    by_template = None
+    if args.batch is not None:
+        # templates are parsed and validated in a pool of processes
+        resources, failed, by_template = __load_batch(args)
+        if args.stream:
+            # as when streaming, resources that are not valid are skipped
+            invalid = set(id(r) for r in failed)
+            resources = create.drain([r for r in resources
+                                      if id(r) not in invalid])
+            if index is not None:
+                resources = dedupe.iter_check(resources, index,
+                                              args.dedupe == 'skip',
+                                              ignore=resumed)
+    elif args.stream:
+        # parse, validate and create each resource as its sheet is read
+        resources = p.iter_valid(__read(args), failed)
+        if index is not None:
+            resources = dedupe.iter_check(resources, index,
+                                          args.dedupe == 'skip',
+                                          ignore=resumed)
+    else:
+        # parse and validate the template
+        resources, failed = __read_valid(args)
 
-    if len(failed) > 0:
+    if len(failed) > 0 and not args.stream:
         res = input('Would you like to continue [Y/n]? ')
         if res.lower() == 'n':
             __exit()
@@ -118,25 +383,117 @@ if __name__ == "__main__":
             if res.lower() != 'y':
                 __exit()
 
+    if args.sync:
+        # update the resources created by an earlier run in place
+        resids = {}
+        if args.journal is not None:
+            resids = Journal(args.journal).resources()
+        print('\n' + 50*'-')
+        print('Begin syncing HydroShare resources')
+        print(50*'-')
+        if isinstance(resources, list):
+            resources = create.drain(resources)
+        results = sync.sync_many(hs, resources, resids,
+                                 workers=args.workers,
+                                 max_inflight=args.max_inflight,
+                                 request_policy=policy.RequestPolicy(
+                                     rate=args.rate, retries=args.retries),
+                                 step_workers=args.step_workers,
+                                 dry_run=args.diff,
+                                 chunk_size=args.chunk_size * 2**20,
+                                 dedupe_index=index)
+        sync.report(results)
+        __finish(args)
+
+    if index is not None and not args.stream:
+        print('Checking for duplicate content')
+        dup = dedupe.check(resources, index, args.dedupe == 'skip',
+                           ignore=resumed)
+        print('  %d duplicate bytes found' % dup)
+
+    # created before ordering so that the plan counts the unzip steps of
+    # compressed files
+    compressor = __compressor(args)
+    if not args.stream and args.order == 'longest-first':
+        resources = plan.order(resources, workers=args.workers,
+                               step_workers=args.step_workers,
+                               bundle_threshold=args.bundle_threshold * 2**10,
+                               compressor=compressor)
+
+    request_policy = policy.RequestPolicy(rate=args.rate,
+                                          retries=args.retries)
+
+    journal = None
+    if args.journal is not None:
+        journal = Journal(args.journal)
+    elif args.rollback == 'retry-then-delete':
+        # retrying resumes failed resources from the steps they completed
+        tmp = tempfile.NamedTemporaryFile(prefix='hs-bulk-', suffix='.jsonl',
+                                          delete=False)
+        tmp.close()
+        journal = Journal(tmp.name)
+        atexit.register(os.remove, tmp.name)
+
+    existing = None
+    if args.duplicates is not None:
+        print('Refreshing the catalog of existing resources')
+        existing = catalog.open_catalog(hs, args.catalog, args.full_refresh,
+                                        max(args.workers, 4))
+        # resources of the run being resumed are not duplicates
+        ignore = set(journal.resources().values()) \
+            if journal is not None and args.resume else set()
+        skip = args.duplicates == 'skip'
+        if args.stream:
+            resources = catalog.iter_check(resources, existing, skip, ignore)
+        else:
+            print('Checking for existing resources')
+            resources, duplicates = catalog.check(resources, existing, skip,
+                                                  ignore)
+            print('  %d resources already exist' % len(duplicates))
+
     print('\n' + 50*'-')
     print('Begin creating HydroShare resources')
     print(50*'-')
-    created, errors = create.create_many(hs, resources)
+    if isinstance(resources, list):
+        # only the resources still in flight are kept in memory
+        resources = create.drain(resources)
+    created, errors = create.create_many(hs, resources,
+                                         workers=args.workers,
+                                         max_inflight=args.max_inflight,
+                                         step_workers=args.step_workers,
+                                         request_policy=request_policy,
+                                         journal=journal,
+                                         resume=args.resume,
+                                         chunk_size=args.chunk_size * 2**20,
+                                         bundle_threshold=args.bundle_threshold * 2**10,
+                                         dedupe_index=index,
+                                         compressor=compressor,
+                                         catalog=existing)
 
     if len(errors) > 0:
         print('\n' + 50*'-')
         print('The following errors were encountered:')
         print(50*'-' + '\n')
-        for r, d in errors.items():
-            res = input('  %s: %s.\nWould you like to delete it [Y/n]?'
-                        % (r, d['error']))
-            if res != 'n':
-                print('  deleting resource id=%s' % r, end='')
-                hs.deleteResource(r)
-                print('done')
-            else:
-                # add the resource to the created list since it was not deleted
-                created[r] = d['title']
+        kept, errors = rollback.rollback(hs, errors, args.rollback,
+                                         workers=max(args.workers, 4),
+                                         journal=journal,
+                                         step_workers=args.step_workers,
+                                         chunk_size=args.chunk_size * 2**20,
+                                         bundle_threshold=args.bundle_threshold * 2**10,
+                                         dedupe_index=index,
+                                         compressor=compressor,
+                                         catalog=existing)
+        # failed resources that were not deleted are listed as created
+        created.update(kept)
+    if compressor is not None:
+        compressor.shutdown()
+
+    if args.stream and len(failed) > 0:
+        print('\n' + 50*'-')
+        print('The following resources failed validation and were skipped:')
+        print(50*'-')
+        for r in failed:
+            print('  %s: %s' % (r.sheet, r.title))
 
     if len(created) > 0:
         print('\n' + 50*'-')
@@ -145,5 +502,8 @@ if __name__ == "__main__":
         for r, t in created.items():
             print('\n  %s\n  %s/resource/%s' % (t, args.address, r))
 
-    __exit()
+    if by_template is not None:
+        batch.report(by_template, errors, failed if args.stream else ())
+
+    __finish(args)
 
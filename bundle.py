@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+
+import os
+import shutil
+import zipfile
+import tempfile
+from resource import stat_cache
+
+bundle_name = 'hs-bulk-bundle.zip'
+
+
+def partition(files, threshold):
+    """
+    Splits the files of a resource into those that should be bundled
+    into a single archive (smaller than threshold bytes) and those that
+    should be uploaded individually.  Files that are themselves unzipped
+    on the server are never bundled.  Bundling is only worthwhile for
+    two or more files.
+    """
+    if not threshold:
+        return [], list(files)
+    small = [f for f in files
+             if not f['unzip'] and stat_cache.size(f['path']) < threshold]
+    if len(small) < 2:
+        return [], list(files)
+    return small, [f for f in files if f not in small]
+
+
+def arcnames(files):
+    """
+    Returns the path of each file inside the archive, relative to the
+    deepest directory the files have in common.
+    """
+    paths = [os.path.abspath(f['path']) for f in files]
+    base = os.path.commonpath([os.path.dirname(p) for p in paths])
+    return {f['path']: os.path.relpath(p, base)
+            for f, p in zip(files, paths)}
+
+
+def make_bundle(files, compression=zipfile.ZIP_DEFLATED, name=bundle_name):
+    """
+    Writes the files into a new zip archive in a temporary directory and
+    returns its path.  Remove it with cleanup() once it has been uploaded.
+    """
+    tmpdir = tempfile.mkdtemp(prefix='hs-bulk-')
+    path = os.path.join(tmpdir, name)
+    with zipfile.ZipFile(path, 'w', compression) as z:
+        for fpath, arcname in arcnames(files).items():
+            z.write(fpath, arcname)
+    return path
+
+
+def cleanup(path):
+    shutil.rmtree(os.path.dirname(path), ignore_errors=True)
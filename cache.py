@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+"""
+On-disk cache of the resources parsed and validated from templates.
+
+Each sheet is stored under a digest of its content, and each workbook
+under the digest of the file, so an unchanged template is loaded without
+being opened and only the sheets that changed are parsed again.  Cached
+resources keep the size and mtime of the files they reference, and are
+validated again only if one of those files changed.
+"""
+
+import os
+import struct
+import pickle
+import hashlib
+import tempfile
+import threading
+import dedupe
+
+default_dir = os.path.join(os.path.expanduser('~'), '.hs_bulk_cache')
+default_max_size = 256 * 2**20
+
+# BIFF record types, see xlrd.biffh
+_bof = 0x0809
+_eof = 0x000a
+_labelsst = 0x00fd
+
+
+def _code_version():
+    # entries written by a different parser or validator are not reused
+    h = hashlib.sha256()
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in ('parse.py', 'resource.py', 'cache.py'):
+        with open(os.path.join(here, name), 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+version = _code_version()
+
+
+def workbook_key(template):
+    return 'workbook-' + hashlib.sha256(
+        (version + dedupe.hash_file(template)).encode()).hexdigest()
+
+
+def sheet_keys(book, workbook):
+    """
+    Returns a cache key for each sheet of an open workbook.  For .xls
+    workbooks loaded on demand the key is a digest of the sheet's own
+    records and of the shared strings they use, computed without loading
+    the sheet, so editing one sheet does not invalidate the others.
+    Otherwise the keys are derived from the workbook key.
+    """
+    names = book.sheet_names()
+    positions = getattr(book, '_sh_abs_posn', [])
+    mem = getattr(book, 'mem', None)
+    keys = []
+    for i, name in enumerate(names):
+        h = hashlib.sha256(('%s\0%s\0%s\0' % (version, book.datemode,
+                                              name)).encode())
+        if mem is not None and len(positions) == len(names):
+            _digest_sheet(h, mem, positions[i], book._sharedstrings)
+        else:
+            h.update(('%s\0%d' % (workbook, i)).encode())
+        keys.append('sheet-' + h.hexdigest())
+    return keys
+
+
+def _digest_sheet(h, mem, pos, sst):
+    # the records of a worksheet run from its BOF to the matching EOF;
+    # cells holding text only refer to the shared string table, so the
+    # strings themselves are added to the digest
+    start = pos
+    depth = 0
+    while pos + 4 <= len(mem):
+        rc, length = struct.unpack_from('<HH', mem, pos)
+        if rc == _labelsst and length >= 10:
+            i = struct.unpack_from('<I', mem, pos + 10)[0]
+            h.update((sst[i] if i < len(sst) else '').encode('utf-8'))
+            h.update(b'\0')
+        elif rc == _bof:
+            depth += 1
+        pos += 4 + length
+        if rc == _eof:
+            depth -= 1
+            if depth <= 0:
+                break
+    h.update(mem[start:pos])
+
+
+class TemplateCache(object):
+    """
+    Directory of pickled cache entries, one file per key.  Entries are
+    evicted least recently used first once the directory grows beyond
+    max_size bytes.  Entries are written atomically, so several processes
+    can share a cache.
+    """
+
+    def __init__(self, directory=default_dir, max_size=default_max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(size for path, size, atime in self._entries())
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.pickle'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path, st.st_size, st.st_mtime))
+        return entries
+
+    def get(self, key):
+        """
+        Returns the value stored under key, or None.
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # a corrupt or incompatible entry is a miss
+            return None
+        try:
+            # the mtime records the last use for eviction
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, self._path(key))
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        with self.lock:
+            self.size += len(data)
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is no
+        larger than max_size.
+        """
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        self.size = sum(e[1] for e in entries)
+        for path, size, atime in entries:
+            if self.size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+
+    def clear(self):
+        for path, size, atime in self._entries():
+            os.remove(path)
+        self.size = 0
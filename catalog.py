@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+"""
+Local catalog of the resources a user already owns on HydroShare, used
+to find template resources that would duplicate one of them before
+anything is created.
+"""
+
+import os
+import json
+import math
+import time
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import create
+
+default_catalog = os.path.join(os.path.expanduser('~'), '.hs_bulk_catalog.db')
+default_page_size = 100
+
+# the list endpoint filters by creation date only, so an incremental
+# refresh starts a day before the last one to cover clock and time zone
+# differences
+refresh_overlap = 24 * 3600
+
+
+def normalize_title(title):
+    return ' '.join(str(title).lower().split())
+
+
+def _keywords(keywords):
+    return sorted(set(str(k).strip().lower() for k in keywords))
+
+
+class ResourceCatalog(object):
+    """
+    sqlite database of the title, type, keywords and id of the resources
+    owned by a user on a HydroShare host, held in memory for lookups.
+    The list endpoint does not return keywords, so they are only known
+    for the resources this tool created, which are added as they are
+    created.
+    """
+
+    def __init__(self, host, owner, path=default_catalog):
+        self.host = host
+        self.owner = owner
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS resources (
+                host TEXT, owner TEXT, resid TEXT, title TEXT, type TEXT,
+                keywords TEXT, date_created TEXT,
+                PRIMARY KEY (host, resid));
+            CREATE TABLE IF NOT EXISTS refreshes (
+                host TEXT, owner TEXT, time REAL,
+                PRIMARY KEY (host, owner));
+            ''')
+        self.by_title = {}
+        self._load()
+
+    def _load(self):
+        self.by_title = {}
+        rows = self.db.execute('SELECT resid, title, type, keywords, '
+                               'date_created FROM resources '
+                               'WHERE host=? AND owner=?',
+                               (self.host, self.owner)).fetchall()
+        for resid, title, rtype, keywords, created in rows:
+            self._index(resid, title, rtype,
+                        json.loads(keywords) if keywords else None, created)
+
+    def _index(self, resid, title, rtype, keywords, created):
+        entries = self.by_title.setdefault(normalize_title(title), {})
+        entries[resid] = dict(resid=resid, title=title, type=rtype,
+                              keywords=keywords, date_created=created)
+
+    def __len__(self):
+        return sum(len(v) for v in self.by_title.values())
+
+    def last_refresh(self):
+        row = self.db.execute('SELECT time FROM refreshes WHERE host=? AND '
+                              'owner=?', (self.host, self.owner)).fetchone()
+        return row[0] if row is not None else None
+
+    def refresh(self, hs, full=False, workers=4,
+                page_size=default_page_size):
+        """
+        Fetches the user's resources created since the last refresh, or
+        all of them if full is True or the catalog is new.  The first
+        page gives the number of pages, which are then fetched in
+        parallel.  A full refresh also drops resources that no longer
+        exist.  Returns the number of resources fetched.
+        """
+        last = self.last_refresh()
+        params = {'owner': self.owner}
+        if last is not None and not full:
+            params['from_date'] = time.strftime(
+                '%Y-%m-%d', time.gmtime(last - refresh_overlap))
+        else:
+            full = True
+        st = time.time()
+
+        pages = [_page(hs, params, 1, page_size)]
+        served = len(pages[0]['results'])
+        if served > 0 and pages[0]['count'] > served:
+            npages = int(math.ceil(pages[0]['count'] / float(served)))
+            with ThreadPoolExecutor(max_workers=min(workers,
+                                                    npages - 1)) as pool:
+                pages.extend(pool.map(
+                    lambda n: _page(hs, params, n, served),
+                    range(2, npages + 1)))
+
+        fetched = {}
+        for page in pages:
+            for item in page['results']:
+                fetched[item['resource_id']] = item
+
+        with self.lock:
+            if full:
+                known = set(resid for v in self.by_title.values()
+                            for resid in v)
+                self.db.executemany(
+                    'DELETE FROM resources WHERE host=? AND resid=?',
+                    [(self.host, resid) for resid in known - set(fetched)])
+            # keywords recorded for resources created by this tool are kept
+            self.db.executemany(
+                'INSERT INTO resources (host, owner, resid, title, type, '
+                'date_created) VALUES (?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (host, resid) DO UPDATE SET '
+                'title=excluded.title, type=excluded.type, '
+                'date_created=excluded.date_created',
+                [(self.host, self.owner, resid, item['resource_title'],
+                  item['resource_type'], item.get('date_created'))
+                 for resid, item in fetched.items()])
+            self.db.execute('INSERT OR REPLACE INTO refreshes VALUES '
+                            '(?, ?, ?)', (self.host, self.owner, st))
+            self.db.commit()
+            self._load()
+        print('  %d resources fetched in %d pages (%s), %d in catalog'
+              % (len(fetched), len(pages),
+                 'full' if full else 'since %s' % params['from_date'],
+                 len(self)))
+        return len(fetched)
+
+    def add(self, resid, title, rtype, keywords):
+        """
+        Records a resource created by this run.
+        """
+        keywords = _keywords(keywords)
+        created = time.strftime('%Y-%m-%dT%H:%M:%S')
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO resources VALUES '
+                            '(?, ?, ?, ?, ?, ?, ?)',
+                            (self.host, self.owner, resid, title, rtype,
+                             json.dumps(keywords), created))
+            self.db.commit()
+            self._index(resid, title, rtype, keywords, created)
+
+    def remove(self, resid):
+        with self.lock:
+            self.db.execute('DELETE FROM resources WHERE host=? AND resid=?',
+                            (self.host, resid))
+            self.db.commit()
+            for entries in self.by_title.values():
+                entries.pop(resid, None)
+
+    def find(self, resource):
+        """
+        Returns the catalog entries the resource would duplicate: those
+        with the same title and type, and the same keywords where they
+        are known.
+        """
+        keywords = _keywords(resource.keywords)
+        with self.lock:
+            entries = list(self.by_title.get(normalize_title(resource.title),
+                                             {}).values())
+        return [e for e in entries
+                if e['type'].lower() == str(resource.type).lower() and
+                (e['keywords'] is None or e['keywords'] == keywords)]
+
+    def close(self):
+        self.db.close()
+
+
+def _page(hs, params, page, page_size):
+    # the client's resource list fetches one page after the other
+    response = create._call(hs, hs._request, 'GET',
+                            '%s/resource/' % hs.url_base,
+                            params=dict(params, page=page, count=page_size))
+    return response.json()
+
+
+def open_catalog(hs, path=default_catalog, full=False, workers=4):
+    """
+    Opens the catalog of the authenticated user's resources on the host
+    of hs and refreshes it.
+    """
+    owner = create._call(hs, hs.getUserInfo)['username']
+    c = ResourceCatalog(hs.url_base, owner, path)
+    c.refresh(hs, full, workers)
+    return c
+
+
+def check(resources, catalog, skip=False, ignore=(), seen=None):
+    """
+    Reports the resources that duplicate one in the catalog or one
+    earlier in this run.  ignore is a set of resource ids not to report,
+    e.g. those of a run being resumed.  Returns the resources to create,
+    without the duplicates if skip is True, and the duplicates.
+    """
+    seen = {} if seen is None else seen
+    keep = []
+    duplicates = []
+    for r in resources:
+        where = ['%s (%s)' % (e['resid'], (e['date_created'] or '')[:10])
+                 for e in catalog.find(r) if e['resid'] not in ignore]
+        key = (normalize_title(r.title), str(r.type).lower(),
+               tuple(_keywords(r.keywords)))
+        if key in seen:
+            where.append('%s (this run)' % seen[key])
+        seen.setdefault(key, r.sheet or r.title)
+
+        if len(where) > 0:
+            duplicates.append(r)
+            print('  %s: already exists as %s%s'
+                  % (r.title, ', '.join(where), ', skipping' if skip else ''))
+            if skip:
+                continue
+        keep.append(r)
+    return keep, duplicates
+
+
+def iter_check(resources, catalog, skip=False, ignore=()):
+    """
+    Runs check() on each resource as it is produced.
+    """
+    seen = {}
+    for r in resources:
+        keep, duplicates = check([r], catalog, skip, ignore, seen)
+        for k in keep:
+            yield k
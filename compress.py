@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+"""
+Compresses text files into zip archives in a pool of processes ahead of
+their upload, so that fewer bytes are sent and the archives are
+expanded on the server.
+"""
+
+import os
+import threading
+import bundle
+from resource import stat_cache
+
+compressible_extensions = ('.csv', '.tsv', '.txt', '.asc', '.json',
+                           '.geojson', '.xml', '.gml', '.kml', '.prj',
+                           '.md', '.sql', '.log')
+
+# files smaller than this are not worth an extra unzip call
+default_min_size = 64 * 1024
+
+# archives must save at least this fraction of the file to be used
+min_saving = 0.1
+
+
+def archive_name(path):
+    return os.path.basename(path) + '.zip'
+
+
+def _compress(path):
+    # runs in a worker process
+    zpath = bundle.make_bundle([{'path': path}], name=archive_name(path))
+    if os.path.getsize(zpath) > (1 - min_saving) * os.path.getsize(path):
+        bundle.cleanup(zpath)
+        return None
+    return zpath
+
+
+class Compressor(object):
+    """
+    Compresses eligible files in a pool of processes.  Files are
+    submitted as resources are handed out to be created, so compression
+    runs ahead of the uploads, and result() waits for a file's archive.
+    """
+
+    def __init__(self, processes=None, min_size=default_min_size):
+        from concurrent.futures import ProcessPoolExecutor
+        self.min_size = min_size
+        self.pool = ProcessPoolExecutor(max_workers=processes)
+        self.futures = {}
+        self.lock = threading.Lock()
+
+    def eligible(self, f):
+        return not f['unzip'] and \
+            f['path'].lower().endswith(compressible_extensions) and \
+            stat_cache.size(f['path']) >= self.min_size
+
+    def submit(self, f):
+        # keyed by record rather than path, so resources sharing a file
+        # each get an archive of their own
+        with self.lock:
+            if id(f) not in self.futures:
+                self.futures[id(f)] = (f, self.pool.submit(_compress,
+                                                           f['path']))
+
+    def prefetch(self, resources):
+        """
+        Yields the resources, starting the compression of their eligible
+        files as each is taken.
+        """
+        for r in resources:
+            for f in r.files:
+                if self.eligible(f):
+                    self.submit(f)
+            yield r
+
+    def result(self, f):
+        """
+        Returns the path of the archive of a file, or None if it does not
+        compress well.  The archive belongs to the caller, who removes it
+        with bundle.cleanup().
+        """
+        self.submit(f)
+        with self.lock:
+            future = self.futures[id(f)][1]
+        try:
+            return future.result()
+        finally:
+            with self.lock:
+                self.futures.pop(id(f), None)
+
+    def shutdown(self):
+        self.pool.shutdown(cancel_futures=True)
+        for f, future in self.futures.values():
+            if future.done() and not future.cancelled() and \
+                    future.exception() is None and \
+                    future.result() is not None:
+                bundle.cleanup(future.result())
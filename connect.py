@@ -2,16 +2,65 @@
 
 
 import getpass
+from requests.adapters import HTTPAdapter
+from oauthlib.oauth2 import OAuth2Error
 from hs_restclient import (HydroShare,
                            HydroShareAuthBasic,
-                           HydroShareHTTPException)
+                           HydroShareAuthOAuth2,
+                           HydroShareHTTPException,
+                           HydroShareNotAuthorized,
+                           HydroShareAuthenticationException)
 
+# errors raised for credentials the server does not accept, by the basic
+# and OAuth2 (token request) authentication of the client
+auth_errors = (HydroShareHTTPException, HydroShareNotAuthorized,
+               HydroShareAuthenticationException, OAuth2Error)
 
-def __connect(username, host='www.hydroshare.org', verify=True):
+default_pool_size = 10
+
+
+class PooledHydroShare(HydroShare):
+    """
+    HydroShare client whose session keeps a pool of persistent
+    connections large enough for every request the run allows in flight,
+    so concurrent calls reuse warm connections instead of opening new
+    ones.  An OAuth2 token fetched once is kept for the rest of the run,
+    including when the client re-creates its session after a connection
+    error.
+    """
+
+    def __init__(self, *args, pool_size=default_pool_size, **kwargs):
+        self.pool_size = pool_size
+        super(PooledHydroShare, self).__init__(*args, **kwargs)
+
+    def _initializeSession(self):
+        super(PooledHydroShare, self)._initializeSession()
+
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.pool_size,
+                              pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['Connection'] = 'keep-alive'
+
+        # reuse the token for every session created during this run
+        if isinstance(self.auth, HydroShareAuthOAuth2) and \
+                self.auth.token is None:
+            self.auth.token = self.session.token
+
+
+def __connect(username, host='www.hydroshare.org', verify=True,
+              pool_size=default_pool_size, client_id=None,
+              client_secret=None):
     u = username
     p = getpass.getpass('Password:')
-    auth = HydroShareAuthBasic(username=u, password=p)
-    return HydroShare(hostname=host, auth=auth, verify=verify)
+    if client_id is not None:
+        auth = HydroShareAuthOAuth2(client_id, client_secret, hostname=host,
+                                    username=u, password=p)
+    else:
+        auth = HydroShareAuthBasic(username=u, password=p)
+    return PooledHydroShare(hostname=host, auth=auth, verify=verify,
+                            pool_size=pool_size)
 
 
 def connect():
@@ -19,20 +68,23 @@ def connect():
     return __connect(u)
 
 
-def authenticate(username, host='www.hydroshare.org', tries=3, 
-                 ssl_verification=True):
+def authenticate(username, host='www.hydroshare.org', tries=3,
+                 ssl_verification=True, pool_size=default_pool_size,
+                 client_id=None, client_secret=None):
 
     auth_success = False
     attempt = 1
     while not auth_success:
-        hs = __connect(username, host, verify=ssl_verification)
         try:
+            hs = __connect(username, host, verify=ssl_verification,
+                           pool_size=pool_size, client_id=client_id,
+                           client_secret=client_secret)
             hs.getUserInfo()
             auth_success = True
-        except HydroShareHTTPException:
+        except auth_errors:
             print('  Authorization Failed - Attempt %d' % attempt)
         attempt += 1
-        if attempt > tries:
+        if not auth_success and attempt > tries:
             print('  Authorization Failed')
             return 0
 
@@ -2,135 +2,622 @@
 
 
 import os
-import sys
-import xlrd
+import json
 import time
-import getpass
-from resource import Resource
-from datetime import datetime as dt
-import parse as p
-import argparse
-import connect
+import datetime
+import threading
+from urllib.parse import unquote
+from concurrent.futures import (ThreadPoolExecutor, as_completed, wait,
+                                FIRST_COMPLETED)
+from resource import stat_cache
+import scheduler
+from scheduler import Step
+import policy
+import metrics
+import upload
+import bundle
 
+# default number of simultaneous requests allowed against a single host
+default_max_inflight = 4
 
-def create_many(hs, resource_list):
+# slots of the in-flight limit that uploads may not take, so that other
+# requests do not wait for transfers to finish
+reserved_inflight = 1
+
+# calls that add something to the server, which are not repeated after an
+# error that may have followed their success
+non_idempotent = ('createResource', 'addResourceFile', 'upload_file')
+
+_print_lock = threading.Lock()
+_inflight = {}
+_policies = {}
+_inflight_lock = threading.Lock()
+_created = set()
+_existing = {}
+_existing_lock = threading.Lock()
+
+
+class ResourceLog(object):
+    """
+    Collects the progress output for a single resource.  When buffered,
+    messages are held until flush() so that the output of resources
+    created in parallel does not interleave.
+    """
+
+    def __init__(self, buffered=False):
+        self.buffered = buffered
+        self.lines = []
+
+    def __call__(self, msg, end='\n'):
+        if self.buffered:
+            self.lines.append(msg + end)
+        else:
+            with _print_lock:
+                print(msg, end=end, flush=True)
+
+    def flush(self):
+        if self.buffered and len(self.lines) > 0:
+            with _print_lock:
+                print(''.join(self.lines), end='', flush=True)
+        self.lines = []
+
+
+def set_max_inflight(hs, limit):
+    """
+    Sets the maximum number of requests that may be in flight against
+    the host of the given HydroShare connection at the same time.
+    """
+    with _inflight_lock:
+        _inflight[hs.hostname] = _semaphores(limit)
+
+
+def _semaphores(limit):
+    # every request takes a slot of the first, uploads also of the second
+    return (threading.BoundedSemaphore(limit),
+            threading.BoundedSemaphore(max(1, limit - reserved_inflight)))
+
+
+def _host_semaphores(hs):
+    with _inflight_lock:
+        if hs.hostname not in _inflight:
+            _inflight[hs.hostname] = _semaphores(default_max_inflight)
+        return _inflight[hs.hostname]
+
+
+def set_policy(hs, request_policy):
+    """
+    Sets the RequestPolicy used for calls against the host of the given
+    HydroShare connection.
+    """
+    with _inflight_lock:
+        _policies[hs.hostname] = request_policy
+
+
+def _host_policy(hs):
+    with _inflight_lock:
+        if hs.hostname not in _policies:
+            _policies[hs.hostname] = policy.RequestPolicy()
+        return _policies[hs.hostname]
+
+
+def _check(result):
+    # some endpoints return the raw response rather than raising on errors
+    if getattr(result, 'status_code', 0) >= 400:
+        from hs_restclient import HydroShareHTTPException
+        raise HydroShareHTTPException(result)
+    return result
+
+
+def _call(hs, func, *args, recover=None, **kwargs):
+    """
+    Issues a single HydroShare API call through the request policy of
+    the host, respecting its in-flight request limit.  Uploads may only
+    take all but reserved_inflight of the slots.  recover is passed to
+    RequestPolicy.call.
+    """
+    requests, uploads = _host_semaphores(hs)
+    idempotent = getattr(func, '__name__', None) not in non_idempotent
+    if func is upload.upload_file:
+        def attempt():
+            with uploads, requests:
+                return _check(func(*args, **kwargs))
+        return _host_policy(hs).call(attempt, idempotent=idempotent,
+                                     recover=recover)
+
+    # requests other than uploads are given priority over upload data
+    bandwidth = upload.bandwidth()
+
+    def attempt():
+        with requests:
+            if bandwidth is None:
+                return _check(func(*args, **kwargs))
+            bandwidth.begin_request()
+            try:
+                return _check(func(*args, **kwargs))
+            finally:
+                bandwidth.end_request()
+    return _host_policy(hs).call(attempt, idempotent=idempotent,
+                                 recover=recover)
+
+
+def _file_list(hs, resid):
+    # the listing is paged, so it is read whole within a single attempt
+    files = {}
+    for f in hs.getResourceFileList(resid):
+        path = unquote(f['url'].split('/data/contents/', 1)[-1])
+        files[path] = f['size']
+    return files
+
+
+def _recent_resources(hs, since):
+    owner = hs.getUserInfo()['username']
+    return [(item['resource_id'], item['resource_title'],
+             item['resource_type'])
+            for item in hs.resources(owner=owner, from_date=since)]
+
+
+def _existing_resources(hs):
+    """
+    Returns the date from which resources are looked up after a failed
+    create request, and the ids of the user's resources created since
+    then that existed before this run created anything, which are never
+    taken for one created by this run.  The list is read once per run.
+    """
+    with _existing_lock:
+        if hs.url_base not in _existing:
+            # a day early, allowing for clock and time zone differences
+            since = datetime.date.today() - datetime.timedelta(days=1)
+            ids = set(resid for resid, title, rtype in
+                      _call(hs, _recent_resources, hs, since))
+            _existing[hs.url_base] = (since, ids)
+        return _existing[hs.url_base]
+
+
+def _find_resource(hs, title, resource_type):
+    # the most recent matching resource that is neither one that existed
+    # before this run nor one this run created
+    since, existing = _existing_resources(hs)
+    found = None
+    for resid, rtitle, rtype in _call(hs, _recent_resources, hs, since):
+        if rtitle == title and rtype == resource_type and \
+                resid not in existing and resid not in _created:
+            found = resid
+    return found
+
+
+def _create_resource(hs, log, **kwargs):
+    """
+    Creates a resource.  A create request that failed with a gateway
+    error, timeout or dropped connection may still have created the
+    resource, so it is only sent again if no resource created since the
+    run started matches it.
+    """
+    _existing_resources(hs)
+
+    def recover(e):
+        log('  creating resource failed (%s), checking whether it was '
+            'created' % e)
+        return _find_resource(hs, kwargs['title'], kwargs['resource_type'])
+
+    resid = _call(hs, hs.createResource, recover=recover, **kwargs)
+    with _inflight_lock:
+        _created.add(resid)
+    return resid
+
+
+def _upload(hs, resid, path, **kwargs):
+    """
+    Uploads a file and returns the transfer rate.  As with creating
+    resources, an upload that failed in a way that may have reached the
+    server is only repeated if the file is not in the resource.
+    """
+    fname = os.path.basename(path)
+
+    def recover(e):
+        files = _call(hs, _file_list, hs, resid)
+        if files.get(fname) == os.path.getsize(path):
+            return 0.
+        return None
+
+    return _call(hs, upload.upload_file, hs, resid, path, recover=recover,
+                 **kwargs)
+
+
+def _unzip(hs, resid, path, remove_original):
+    # the payload is consumed by the client, so build it for every attempt
+    options = {"zip_with_rel_path": path,
+               "remove_original_zip": remove_original}
+    return hs.resource(resid).functions.unzip(options)
+
+
+def _set_file_type(hs, resid, path, file_type):
+    options = {'file_path': path,
+               'hs_file_type': file_type}
+    return hs.resource(resid).functions.set_file_type(options)
+
+
+def drain(items):
+    """
+    Yields the items of a list, removing each from the list as it is
+    handed out so that resources can be freed once they are finished.
+    """
+    items.reverse()
+    while len(items) > 0:
+        yield items.pop()
+
+
+def create_many(hs, resource_list, workers=1, max_inflight=None,
+                step_workers=4, journal=None, resume=False,
+                request_policy=None, **options):
     created = {}
     errors = {}
-    for r in resource_list:
-        res = create_resource(hs, r)
 
+    if max_inflight is not None:
+        set_max_inflight(hs, max_inflight)
+    if request_policy is not None:
+        set_policy(hs, request_policy)
+    # resources created before this run are listed again when needed
+    with _existing_lock:
+        _existing.pop(hs.url_base, None)
+    if options.get('compressor') is not None:
+        # compress the files of queued resources while others upload
+        resource_list = options['compressor'].prefetch(resource_list)
+
+    def collect(res):
         if res['status'] == 'success':
             created[res['id']] = res['title']
         else:
-            errors[res['id']] = {'error': res['message'],
-                                 'title': res['title']}
+            key = res['id'] if res['id'] is not None else res['title']
+            errors[key] = {'id': res['id'],
+                           'key': res['key'],
+                           'error': res['message'],
+                           'title': res['title'],
+                           'resource': res['resource']}
+
+    if workers <= 1:
+        for r in resource_list:
+            collect(create_resource(hs, r, step_workers=step_workers,
+                                    journal=journal, resume=resume,
+                                    **options))
+        return created, errors
+
+    def work(r):
+        log = ResourceLog(buffered=True)
+        try:
+            return create_resource(hs, r, log, step_workers, journal, resume,
+                                   **options)
+        finally:
+            log.flush()
+
+    # resource_list may be a generator that is still parsing the template,
+    # so only a bounded number of resources are taken from it at a time
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = set()
+        for r in resource_list:
+            futures.add(pool.submit(work, r))
+            if len(futures) >= 2 * workers:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(future.result())
+        for future in as_completed(futures):
+            collect(future.result())
     return created, errors
 
 
-def create_resource(hs, resource):
+def build_steps(hs, resource, log, bundle_threshold=0, catalog=None,
+                **options):
+    """
+    Models the work for a single resource as a dependency graph.  Every
+    step other than create depends only on the resource id, except the
+    per-file unzip, set_file_type and file metadata steps which follow
+    their upload.  Created resources are added to the catalog of
+    existing resources, if given.
+    """
     r = resource
-    resid = None
-    st = time.time()
-    try:
-        print('\nCreating resource: %s' % r.title)
-        resid = hs.createResource(resource_type=r.type,
-                                  title=r.title,
-                                  abstract=r.abstract,
-                                  keywords=r.keywords)
-
-        # set sharing status
-        print('  setting status ', end='')
-        if resource.sharing_status == 'discoverable':
-            print('discoverable... ', end='')
-            hs.resource(resid).discoverable(True)
-        elif resource.sharing_status == 'public':
-            print('public... ', end='')
-            hs.resource(resid).public(True)
+    steps = []
+
+    # custom metadata is sent along with the create request
+    def create(results):
+        extra_metadata = None
+        if len(r.custom_metadata.keys()) > 0:
+            extra_metadata = json.dumps(r.custom_metadata)
+        resid = _create_resource(hs, log,
+                                 resource_type=r.type,
+                                 title=r.title,
+                                 abstract=r.abstract,
+                                 keywords=r.keywords,
+                                 extra_metadata=extra_metadata)
+        log('  created resource id=%s' % resid)
+        if catalog is not None:
+            catalog.add(resid, r.title, r.type, r.keywords)
+        return resid
+    steps.append(Step('create', create))
+
+    # set sharing status
+    def sharing(results):
+        resid = results['create']
+        if r.sharing_status == 'discoverable':
+            _call(hs, hs.resource(resid).discoverable, True)
+        elif r.sharing_status == 'public':
+            _call(hs, hs.resource(resid).public, True)
         else:
-            print('private... ', end='')
-            hs.resource(resid).public(False)
-        print('done')
+            _call(hs, hs.resource(resid).public, False)
+        log('  setting status %s... done' % r.sharing_status)
+    steps.append(Step('sharing', sharing, ['create']))
+
+    def shareable(results):
+        resid = results['create']
+        _call(hs, hs.resource(resid).shareable, bool(r.shareable))
+        log('  setting %s... done'
+            % ('sharable' if r.shareable else 'not sharable'))
+    steps.append(Step('shareable', shareable, ['create']))
+
+    # set the remaining resource level metadata in a single update
+    metadata = science_metadata(r)
+    if len(metadata) > 0:
+        def scimeta(results):
+            _call(hs, hs.updateScienceMetadata, results['create'],
+                  metadata=metadata)
+            log('  setting science metadata... done')
+        steps.append(Step('scimeta', scimeta, ['create']))
+
+    # add files to resource, bundling small files into a single upload
+    bundled, single = bundle.partition(r.files, bundle_threshold)
+    if len(bundled) > 0:
+        steps.extend(build_bundle_steps(hs, bundled, log, **options))
+    for f in single:
+        steps.extend(build_file_steps(hs, f, log, **options))
+
+    return steps
+
+
+def build_file_steps(hs, f, log, chunk_size=upload.default_chunk_size,
+                     dedupe_index=None, compressor=None):
+    fpath = f['path']
+    fname = os.path.basename(fpath)
+    steps = []
+
+    if compressor is not None and compressor.eligible(f):
+        return build_compressed_file_steps(hs, f, log, chunk_size,
+                                           dedupe_index, compressor)
+
+    # upload file
+    def upload_file(results):
+        rate = _upload(hs, results['create'], fpath,
+                       chunk_size=chunk_size, log=log)
+        log('  uploading file: %s... done (%s, %s/s)'
+            % (fname, upload.format_bytes(os.path.getsize(fpath)),
+               upload.format_bytes(rate)))
+        if dedupe_index is not None:
+            dedupe_index.record(fpath, results['create'])
+    last = 'upload:%s' % fpath
+    steps.append(Step(last, upload_file, ['create'],
+                      nbytes=stat_cache.size(fpath)))
+
+    # unzip
+    if f['unzip']:
+        def unzip(results):
+            _call(hs, _unzip, hs, results['create'], fname, False)
+            log('  decompressing file: %s... done' % fname)
+        steps.append(Step('unzip:%s' % fpath, unzip, [last]))
+        last = 'unzip:%s' % fpath
+
+    # set file type
+    if f['type']:
+        steps.append(build_file_type_step(hs, f, fname, log, last))
+        last = 'filetype:%s' % fpath
+
+    # set file level metadata
+    if f.get('metadata'):
+        steps.append(build_file_metadata_step(hs, f, fname, log, last))
+
+    return steps
+
+
+def build_compressed_file_steps(hs, f, log, chunk_size, dedupe_index,
+                                compressor):
+    """
+    Uploads the archive made by the compressor in place of the file and
+    unzips it on the server.  Files that do not compress well are
+    uploaded as they are.
+    """
+    fpath = f['path']
+    fname = os.path.basename(fpath)
+    steps = []
+
+    def upload_file(results):
+        zpath = compressor.result(f)
+        path = zpath or fpath
+        try:
+            rate = _upload(hs, results['create'], path,
+                           chunk_size=chunk_size, log=log)
+            log('  uploading file: %s... done (%s as %s, %s/s)'
+                % (fname, upload.format_bytes(os.path.getsize(fpath)),
+                   upload.format_bytes(os.path.getsize(path)),
+                   upload.format_bytes(rate)))
+        finally:
+            if zpath is not None:
+                bundle.cleanup(zpath)
+        if dedupe_index is not None:
+            dedupe_index.record(fpath, results['create'])
+        return os.path.basename(zpath) if zpath is not None else None
+    uploaded = 'upload:%s' % fpath
+    steps.append(Step(uploaded, upload_file, ['create'],
+                      nbytes=stat_cache.size(fpath)))
+
+    def unzip(results):
+        archive = results[uploaded]
+        if archive is not None:
+            _call(hs, _unzip, hs, results['create'], archive, True)
+            log('  decompressing file: %s... done' % archive)
+    last = 'unzip:%s' % fpath
+    steps.append(Step(last, unzip, [uploaded]))
 
-        if resource.shareable:
-            print('sharable... ', end='')
-            hs.resource(resid).shareable(True)
+    if f['type']:
+        steps.append(build_file_type_step(hs, f, fname, log, last))
+        last = 'filetype:%s' % fpath
+    if f.get('metadata'):
+        steps.append(build_file_metadata_step(hs, f, fname, log, last))
+    return steps
+
+
+def science_metadata(resource):
+    """
+    Returns the resource level science metadata that is not set when the
+    resource is created, for a single updateScienceMetadata request.
+    """
+    metadata = {}
+    if len(resource.authors) > 0:
+        metadata['creators'] = [dict(a) for a in resource.authors]
+    return metadata
+
+
+def file_metadata(meta):
+    """
+    Converts the File Metadata parsed from the template into the payload
+    of the file metadata endpoint.
+    """
+    params = {}
+    if meta['title']:
+        params['title'] = meta['title']
+    if meta['start_dt'] or meta['end_dt']:
+        params['temporal_coverage'] = {'start': meta['start_dt'],
+                                       'end': meta['end_dt']}
+    if meta['coverage']:
+        # the coordinates were converted to numbers by validation
+        sd = meta['spatial_def']
+        coverage = {'type': meta['coverage'].lower(),
+                    'units': 'Decimal degrees',
+                    'projection': 'WGS 84 EPSG:4326'}
+        if meta['location']:
+            coverage['name'] = meta['location']
+        if coverage['type'] == 'point':
+            coverage['north'] = sd['lat']
+            coverage['east'] = sd['lon']
         else:
-            print('not sharable... ', end='')
-            hs.resource(resid).shareable(False)
-        print('done')
+            coverage['northlimit'] = sd['north_lat']
+            coverage['southlimit'] = sd['south_lat']
+            coverage['eastlimit'] = sd['east_lon']
+            coverage['westlimit'] = sd['west_lon']
+        params['spatial_coverage'] = coverage
+    return params
 
-        # set custom metadata
-        if len(r.custom_metadata.keys()) > 0:
-            print('  setting custom metadata...', end='')
-            hs.resource(resid).scimeta.custom(r.custom_metadata)
-            print('done')
-
-        # set science metadata
-        if len(r.authors) > 0:
-            print('  setting science metadata...', end='')
-            hs.updateScienceMetadata(resid,
-                                     metadata={'creators': r.authors})
-            print('done')
-
-        # add files to resource
-        for f in r.files:
-            # upload file
-            fpath = f['path']
-            ftype = f['type']
-            funzip = f['unzip']
-            print('  uploading file: %s...' % fpath.split('/')[-1], end='')
-            hs.addResourceFile(resid, fpath)
-            print('done')
-
-            # unzip
-            if funzip:
-                print('  decompressing file: %s...' % f, end='')
-                options = {"zip_with_rel_path": f,
-                           "remove_original_zip": False}
-                hs.resource(resid).functions.unzip(options)
-                print('done')
-
-            # set file type
-            if ftype:
-                print('  setting file type: %s...' % ftype, end='')
-                path = os.path.join(resid, 'data/contents',
-                                    os.path.basename(f))
-                options = {'file_path': f,
-                           'hs_file_type': ftype}
-                res = hs.resource(resid).functions.set_file_type(options)
-                print('done')
-
-                # check to see if file id/path is in the response
-                import pdb; pdb.set_trace()
-
-            # set file level metadata
-#            if 
-
-
-#            for ss in ['public', 'discoverable', 'shareable']:
-#                print('  setting status %s...' % (ss), end='')
-#                func = getattr(hs.resource(resid), ss)
-#                val = getattr(r, ss)
-#                func(val)
-#                print('done')
-#            hs.resource(resid).public(r.public)
-#            hs.resource(resid).discoverable(r.discoverable)
-#            hs.resource(resid).shareable(r.shareable)
-#            print('done')
-
-
-
-            print('  elapsed time %3.5f seconds' % (time.time() - st))
-            return {'id': resid,
-                    'title': r.title,
-                    'status': 'success',
-                    'message': None}
+
+def build_file_metadata_step(hs, f, rel_path, log, requires):
+    params = file_metadata(f['metadata'])
+
+    def set_file_metadata(results):
+        _call(hs, hs.resource(results['create']).files.metadata, rel_path,
+              params)
+        log('  setting file metadata: %s... done' % rel_path)
+    return Step('filemeta:%s' % f['path'], set_file_metadata, [requires])
+
+
+def build_file_type_step(hs, f, rel_path, log, requires):
+    def set_file_type(results):
+        _call(hs, _set_file_type, hs, results['create'], rel_path, f['type'])
+        log('  setting file type: %s... done' % f['type'])
+    return Step('filetype:%s' % f['path'], set_file_type, [requires])
+
+
+def build_bundle_steps(hs, files, log, chunk_size=upload.default_chunk_size,
+                       dedupe_index=None, compressor=None):
+    """
+    Packs the files into one archive which is uploaded once and unzipped
+    on the server, keeping the files' paths relative to one another.
+    """
+    steps = []
+
+    def upload_bundle(results):
+        path = bundle.make_bundle(files)
+        try:
+            rate = _upload(hs, results['create'], path,
+                           chunk_size=chunk_size, log=log)
+            log('  uploading %d files as %s... done (%s, %s/s)'
+                % (len(files), bundle.bundle_name,
+                   upload.format_bytes(os.path.getsize(path)),
+                   upload.format_bytes(rate)))
+        finally:
+            bundle.cleanup(path)
+        if dedupe_index is not None:
+            for f in files:
+                dedupe_index.record(f['path'], results['create'])
+    steps.append(Step('upload:bundle', upload_bundle, ['create'],
+                      nbytes=sum(stat_cache.size(f['path']) for f in files)))
+
+    def unzip_bundle(results):
+        _call(hs, _unzip, hs, results['create'], bundle.bundle_name, True)
+        log('  decompressing file: %s... done' % bundle.bundle_name)
+    steps.append(Step('unzip:bundle', unzip_bundle, ['upload:bundle']))
+
+    arcnames = bundle.arcnames(files)
+    for f in files:
+        last = 'unzip:bundle'
+        if f['type']:
+            steps.append(build_file_type_step(hs, f, arcnames[f['path']],
+                                              log, last))
+            last = 'filetype:%s' % f['path']
+        if f.get('metadata'):
+            steps.append(build_file_metadata_step(hs, f, arcnames[f['path']],
+                                                  log, last))
+    return steps
+
+
+def create_resource(hs, resource, log=None, step_workers=4, journal=None,
+                    resume=False, **options):
+    r = resource
+    st = time.time()
+    log = log or ResourceLog()
+    results = {}
+    key = r.sheet or r.title
+    done = journal.completed(key) if (journal and resume) else {}
+
+    def record(step):
+        func = step.func
+
+        # time every step under its kind, e.g. upload for upload:<path>
+        kind = step.name.split(':')[0]
+
+        def wrapper(res):
+            if step.name in done:
+                value = done[step.name]
+                metrics.record(kind, 0., 'skipped', resource=key,
+                               name=step.name)
+                log('  %s: already completed, skipping' % step.name)
+            else:
+                with metrics.timed(kind, step.nbytes, resource=key,
+                                   name=step.name):
+                    value = func(res)
+                if journal is not None:
+                    journal.record(key, step.name, value)
+            results[step.name] = value
+            return value
+        step.func = wrapper
+        return step
+
+    try:
+        log('\nCreating resource: %s' % r.title)
+        steps = [record(s) for s in build_steps(hs, r, log, **options)]
+        scheduler.run(steps, workers=step_workers)
+
+        log('  elapsed time %3.5f seconds' % (time.time() - st))
+        metrics.record('resource', time.time() - st, 'ok', r.upload_bytes,
+                       resource=key)
+        return {'id': results['create'],
+                'key': key,
+                'title': r.title,
+                'resource': r,
+                'status': 'success',
+                'message': None}
 
     except Exception as e:
-        print('\n  ERROR ENCOUNTERED')
-        print('\n  elapsed time %3.5f seconds' % (time.time() - st))
-        if resid is not None:
-            return {'id': resid,
-                    'title': r.title,
-                    'status': 'failed',
-                    'message': e}
+        log('\n  ERROR ENCOUNTERED: %s' % e)
+        log('\n  elapsed time %3.5f seconds' % (time.time() - st))
+        metrics.record('resource', time.time() - st, 'error', resource=key,
+                       error=str(e))
+        return {'id': results.get('create'),
+                'key': key,
+                'title': r.title,
+                'resource': r,
+                'status': 'failed',
+                'message': e}
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+"""
+Content-addressed index of the files uploaded by previous runs, used to
+detect duplicate payloads before they are sent again.
+"""
+
+import os
+import mmap
+import time
+import sqlite3
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from resource import stat_cache
+
+default_index = os.path.join(os.path.expanduser('~'), '.hs_bulk_uploads.db')
+hash_block_size = 16 * 1024 * 1024
+
+
+def hash_file(path):
+    """
+    Returns the sha256 digest of a file, read through a memory map in
+    blocks so large files are never held in memory.
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                for i in range(0, len(m), hash_block_size):
+                    h.update(m[i:i + hash_block_size])
+    return h.hexdigest()
+
+
+class HashIndex(object):
+    """
+    sqlite database recording the digest of every local file that has
+    been hashed (keyed by path, size and mtime, so unchanged files are not
+    hashed twice) and the resources each digest has been uploaded to.
+    """
+
+    def __init__(self, path=default_index):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS hashes (
+                path TEXT PRIMARY KEY, size INTEGER, mtime REAL,
+                digest TEXT);
+            CREATE TABLE IF NOT EXISTS uploads (
+                digest TEXT, size INTEGER, resid TEXT, filename TEXT,
+                time REAL);
+            CREATE INDEX IF NOT EXISTS uploads_digest ON uploads (digest);
+            ''')
+
+    def digest(self, path):
+        """
+        Returns the digest of a local file, hashing it only if it changed
+        since it was last hashed.
+        """
+        path = os.path.abspath(path)
+        st = stat_cache.stat(path)
+        if st is None:
+            return None
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime, digest FROM hashes '
+                                  'WHERE path=?', (path,)).fetchone()
+        if row is not None and (row[0], row[1]) == st:
+            return row[2]
+
+        digest = hash_file(path)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO hashes VALUES '
+                            '(?, ?, ?, ?)', (path, st[0], st[1], digest))
+            self.db.commit()
+        return digest
+
+    def digests(self, paths, workers=4):
+        """
+        Hashes many files in parallel, returning a dict keyed by path.
+        """
+        paths = list(set(paths))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return dict(zip(paths, pool.map(self.digest, paths)))
+
+    def uploaded(self, digest):
+        """
+        Returns a list of (resid, filename) the content has been uploaded
+        to.
+        """
+        with self.lock:
+            return self.db.execute('SELECT resid, filename FROM uploads '
+                                   'WHERE digest=?', (digest,)).fetchall()
+
+    def filenames(self, resid):
+        """
+        Returns the names of the files recorded as uploaded to resid.
+        """
+        with self.lock:
+            return set(row[0] for row in self.db.execute(
+                'SELECT filename FROM uploads WHERE resid=?', (resid,)))
+
+    def record(self, path, resid):
+        digest = self.digest(path)
+        with self.lock:
+            self.db.execute('INSERT INTO uploads VALUES (?, ?, ?, ?, ?)',
+                            (digest, stat_cache.size(path), resid,
+                             os.path.basename(path), time.time()))
+            self.db.commit()
+
+    def forget(self, resid, filename=None):
+        """
+        Removes the uploads recorded for a resource that was deleted, or
+        for one of its files.
+        """
+        with self.lock:
+            if filename is None:
+                self.db.execute('DELETE FROM uploads WHERE resid=?',
+                                (resid,))
+            else:
+                self.db.execute('DELETE FROM uploads WHERE resid=? AND '
+                                'filename=?', (resid, filename))
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def check(resources, index, skip=False, workers=4, seen=None, ignore=()):
+    """
+    Hashes the files of the given resources and reports those whose
+    content was uploaded by an earlier run or appears earlier in this
+    one.  If skip is True the duplicates are removed from the resources
+    so they are not uploaded again.  seen maps the digests met so far to
+    the key and title of the resource they belong to.  Uploads to the
+    resources in ignore, e.g. those of a run being resumed, do not
+    count.  Returns the number of duplicate bytes found.
+    """
+    digests = index.digests([f['path'] for r in resources for f in r.files],
+                            workers)
+    seen = {} if seen is None else seen
+    dup_bytes = 0
+    for r in resources:
+        key = r.sheet or r.title
+        keep = []
+        for f in r.files:
+            digest = digests[f['path']]
+            if digest is None:
+                keep.append(f)
+                continue
+            previous = [u for u in index.uploaded(digest)
+                        if u[0] not in ignore]
+            where = ['%s/%s' % u for u in previous]
+            if digest in seen and seen[digest][0] != key:
+                where.append('%s (this run)' % seen[digest][1])
+            seen.setdefault(digest, (key, r.title))
+
+            if len(where) == 0:
+                keep.append(f)
+                continue
+            size = stat_cache.size(f['path'])
+            dup_bytes += size
+            print('  %s: %s already uploaded to %s%s'
+                  % (r.title, os.path.basename(f['path']), ', '.join(where),
+                     ', skipping' if skip else ''))
+            if not skip:
+                keep.append(f)
+        if skip:
+            r.files = keep
+    return dup_bytes
+
+
+def iter_check(resources, index, skip=False, workers=4, ignore=()):
+    """
+    Runs check() on each resource as it is produced.
+    """
+    seen = {}
+    for r in resources:
+        check([r], index, skip, workers, seen, ignore)
+        yield r
@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+
+"""
+Local stand-in for the HydroShare REST API, implementing the endpoints
+used by this tool with configurable latency, bandwidth and error
+injection.  Resources and files are only recorded in memory.
+"""
+
+import io
+import re
+import json
+import time
+import uuid
+import random
+import zipfile
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+resource_types = ['CompositeResource', 'GenericResource']
+
+# uploaded zip files up to this size are kept so they can be unzipped
+max_zip_size = 256 * 1024 * 1024
+
+
+def _multipart(body, content_type):
+    """
+    Splits a multipart/form-data body into a dict of
+    name: (filename, value).
+    """
+    boundary = re.search(r'boundary=(.+)', content_type).group(1)
+    fields = {}
+    for part in body.split(b'--' + boundary.encode()):
+        if b'\r\n\r\n' not in part:
+            continue
+        head, value = part.split(b'\r\n\r\n', 1)
+        name = re.search(rb'name="([^"]*)"', head)
+        if name is None:
+            continue
+        filename = re.search(rb'filename="([^"]*)"', head)
+        fields[name.group(1).decode()] = (
+            filename.group(1).decode() if filename else None,
+            value[:-2] if value.endswith(b'\r\n') else value)
+    return fields
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    routes = [('GET', r'/hsapi/userInfo/$', 'user_info'),
+              ('GET', r'/hsapi/resource/types/?$', 'types'),
+              ('GET', r'/hsapi/resource/$', 'list_resources'),
+              ('POST', r'/hsapi/resource/$', 'create'),
+              ('DELETE', r'/hsapi/resource/(\w+)/$', 'delete'),
+              ('POST', r'/hsapi/resource/(\w+)/flag/$', 'flag'),
+              ('GET', r'/hsapi/resource/(\w+)/sysmeta/$', 'sysmeta'),
+              ('GET', r'/hsapi/resource/(\w+)/scimeta/elements/?$',
+               'get_scimeta'),
+              ('PUT', r'/hsapi/resource/(\w+)/scimeta/elements/$',
+               'scimeta'),
+              ('GET', r'/hsapi/resource/(\w+)/scimeta/custom/$',
+               'get_custom'),
+              ('POST', r'/hsapi/resource/(\w+)/scimeta/custom/$', 'custom'),
+              ('GET', r'/hsapi/resource/(\w+)/files/$', 'list_files'),
+              ('POST', r'/hsapi/resource/(\w+)/files/$', 'upload'),
+              ('GET', r'/hsapi/resource/(\w+)/files/metadata/(.+)/$',
+               'get_file_metadata'),
+              ('PUT', r'/hsapi/resource/(\w+)/files/metadata/(.+)/$',
+               'file_metadata'),
+              ('DELETE', r'/hsapi/resource/(\w+)/files/(.+)$',
+               'delete_file'),
+              ('POST', r'/hsapi/resource/(\w+)/functions/unzip/(.+)/$',
+               'unzip'),
+              ('POST', r'/hsapi/resource/(\w+)/functions/set-file-type/'
+               r'(.+)/(\w+)/$', 'set_file_type')]
+
+    def log_message(self, *args):
+        pass
+
+    def _read_body(self):
+        # consume the request body no faster than the configured bandwidth
+        length = int(self.headers.get('Content-Length') or 0)
+        bandwidth = self.server.bandwidth
+        chunks = []
+        remaining = length
+        st = time.time()
+        while remaining > 0:
+            chunk = self.rfile.read(min(65536, remaining))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+            if bandwidth:
+                ahead = (length - remaining) / bandwidth - (time.time() - st)
+                if ahead > 0:
+                    time.sleep(ahead)
+        return b''.join(chunks)
+
+    def _respond(self, status, payload=None):
+        body = json.dumps(payload).encode() if payload is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _dispatch(self, method):
+        st = time.time()
+        url = urlparse(self.path)
+        body = self._read_body()
+        for m, pattern, name in self.routes:
+            match = re.match(pattern, url.path)
+            if m == method and match:
+                break
+        else:
+            self._respond(404, {'detail': 'not found'})
+            return
+
+        server = self.server
+        if server.latency:
+            time.sleep(max(0, random.gauss(server.latency,
+                                           server.latency / 4)))
+        if random.random() < server.error_rate:
+            status, payload = 503, {'detail': 'injected error'}
+        else:
+            args = [unquote(a) for a in match.groups()]
+            with server.lock:
+                if args and args[0] not in server.resources:
+                    status, payload = 404, {'detail': 'resource not found'}
+                else:
+                    try:
+                        status, payload = getattr(self, name)(
+                            body, parse_qs(url.query), *args)
+                    except Exception as e:
+                        status, payload = 500, {'detail': str(e)}
+            # the request was processed but the response is lost
+            if status < 400 and random.random() < server.late_error_rate:
+                status, payload = 502, {'detail': 'injected late error'}
+        self._respond(status, payload)
+        server.record(name, time.time() - st, len(body), status)
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    # endpoints, called with the server lock held
+
+    def user_info(self, body, query):
+        return 200, {'username': 'bench', 'first_name': 'Bench',
+                     'last_name': 'User', 'email': 'bench@example.com'}
+
+    def types(self, body, query):
+        return 200, [{'resource_type': t} for t in resource_types]
+
+    def list_resources(self, body, query):
+        items = sorted(self.server.resources.values(),
+                       key=lambda r: r['seq'])
+        if 'from_date' in query:
+            items = [r for r in items
+                     if r['date_created'][:10] >= query['from_date'][0]]
+        page = int(query.get('page', ['1'])[0])
+        count = int(query.get('count', [self.server.page_size])[0])
+        results = [dict(resource_id=r['id'],
+                        resource_title=r['title'],
+                        resource_type=r['type'],
+                        date_created=r['date_created'],
+                        date_last_updated=r['date_last_updated'])
+                   for r in items[(page - 1) * count:page * count]]
+        base = 'http://%s:%d/hsapi/resource/' % self.server.server_address
+        nxt = '%s?page=%d&count=%d' % (base, page + 1, count) \
+            if page * count < len(items) else None
+        return 200, {'count': len(items), 'next': nxt, 'previous': None,
+                     'results': results}
+
+    def create(self, body, query):
+        fields = _multipart(body, self.headers['Content-Type'])
+
+        def value(k):
+            return fields[k][1].decode() if k in fields else None
+
+        if value('resource_type') not in resource_types:
+            return 400, {'detail': 'invalid resource type'}
+        resid = uuid.uuid4().hex
+        self.server.created += 1
+        now = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.server.resources[resid] = dict(
+            id=resid, title=value('title'), type=value('resource_type'),
+            abstract=value('abstract'),
+            keywords=[v[1].decode() for k, v in sorted(fields.items())
+                      if k.startswith('keywords[')],
+            # the server keeps custom metadata values as strings
+            custom={k: str(v) for k, v in
+                    json.loads(value('extra_metadata') or '{}').items()},
+            scimeta={}, flags=set(), public=False, discoverable=False,
+            shareable=True, files={}, date_created=now,
+            date_last_updated=now, seq=self.server.created)
+        return 201, {'resource_id': resid}
+
+    def delete(self, body, query, resid):
+        del self.server.resources[resid]
+        return 204, None
+
+    def flag(self, body, query, resid):
+        flag = parse_qs(body.decode()).get('flag', [''])[0]
+        r = self.server.resources[resid]
+        r['flags'].add(flag)
+        for name in ('public', 'discoverable', 'shareable'):
+            if flag == 'make_' + name:
+                r[name] = True
+            elif flag == 'make_not_' + name:
+                r[name] = False
+        if flag == 'make_private':
+            r['public'] = r['discoverable'] = False
+        if r['public']:
+            r['discoverable'] = True
+        return 202, None
+
+    def sysmeta(self, body, query, resid):
+        r = self.server.resources[resid]
+        return 200, dict(resource_id=resid, resource_title=r['title'],
+                         resource_type=r['type'], public=r['public'],
+                         discoverable=r['discoverable'],
+                         shareable=r['shareable'],
+                         date_created=r['date_created'],
+                         date_last_updated=r['date_last_updated'])
+
+    def get_scimeta(self, body, query, resid):
+        r = self.server.resources[resid]
+        meta = dict(title=r['title'], description=r['abstract'],
+                    subjects=[{'value': k} for k in r['keywords']])
+        meta.update(r['scimeta'])
+        return 200, meta
+
+    def scimeta(self, body, query, resid):
+        r = self.server.resources[resid]
+        r['scimeta'].update(json.loads(body.decode()))
+        return 202, r['scimeta']
+
+    def get_custom(self, body, query, resid):
+        return 200, self.server.resources[resid]['custom']
+
+    def custom(self, body, query, resid):
+        custom = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+        self.server.resources[resid]['custom'].update(custom)
+        return 200, None
+
+    def list_files(self, body, query, resid):
+        base = 'http://%s:%d/resource/%s/data/contents/' % (
+            self.server.server_address + (resid,))
+        results = [dict(url=base + name, size=f['size'],
+                        content_type='application/octet-stream')
+                   for name, f in self.server.resources[resid]['files']
+                   .items()]
+        return 200, {'count': len(results), 'next': None, 'previous': None,
+                     'results': results}
+
+    def upload(self, body, query, resid):
+        fields = _multipart(body, self.headers['Content-Type'])
+        filename, content = fields['file']
+        folder = fields['folder'][1].decode() if 'folder' in fields else ''
+        path = '/'.join([p for p in (folder, filename) if p])
+        f = dict(size=len(content))
+        if path.endswith('.zip') and len(content) <= max_zip_size:
+            f['content'] = content
+        self.server.resources[resid]['files'][path] = f
+        return 201, {'resource_id': resid, 'file_name': path}
+
+    def delete_file(self, body, query, resid, path):
+        files = self.server.resources[resid]['files']
+        if path not in files:
+            return 404, {'detail': 'file not found'}
+        del files[path]
+        return 200, {'resource_id': resid}
+
+    def get_file_metadata(self, body, query, resid, path):
+        files = self.server.resources[resid]['files']
+        if path not in files:
+            return 404, {'detail': 'file not found'}
+        return 200, files[path].get('metadata') or {}
+
+    def file_metadata(self, body, query, resid, path):
+        files = self.server.resources[resid]['files']
+        if path not in files:
+            return 404, {'detail': 'file not found'}
+        files[path]['metadata'] = json.loads(body.decode())
+        return 200, files[path]['metadata']
+
+    def unzip(self, body, query, resid, path):
+        files = self.server.resources[resid]['files']
+        if path not in files or 'content' not in files[path]:
+            return 400, {'detail': 'cannot unzip %s' % path}
+        folder = path.rsplit('/', 1)[0] + '/' if '/' in path else ''
+        with zipfile.ZipFile(io.BytesIO(files[path]['content'])) as z:
+            for info in z.infolist():
+                if not info.is_dir():
+                    files[folder + info.filename] = dict(size=info.file_size)
+        options = parse_qs(body.decode())
+        if options.get('remove_original_zip', ['False'])[0] == 'True':
+            del files[path]
+        return 200, {'unzipped_path': folder}
+
+    def set_file_type(self, body, query, resid, path, file_type):
+        files = self.server.resources[resid]['files']
+        if path not in files:
+            return 400, {'detail': 'file not found: %s' % path}
+        files[path]['type'] = file_type
+        return 201, {'message': 'file type set'}
+
+
+class FakeHydroShare(ThreadingHTTPServer):
+    """
+    latency: mean seconds added to every request
+    bandwidth: bytes/second at which each request body is read (0 is
+        unlimited)
+    error_rate: fraction of requests answered with 503
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0., bandwidth=0,
+                 error_rate=0., page_size=100, late_error_rate=0.):
+        ThreadingHTTPServer.__init__(self, address, Handler)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.late_error_rate = late_error_rate
+        self.page_size = page_size
+        self.lock = threading.Lock()
+        self.resources = {}
+        self.created = 0
+        self.stats = {}
+
+    def record(self, endpoint, elapsed, nbytes, status):
+        with self.lock:
+            s = self.stats.setdefault(endpoint, dict(times=[], bytes=0,
+                                                     errors=0))
+            s['times'].append(elapsed)
+            s['bytes'] += nbytes
+            if status >= 400:
+                s['errors'] += 1
+
+    def start(self):
+        """
+        Serves requests on a background thread and returns the port.
+        """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.server_address[1]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Local stand-in for the '
+                                     'HydroShare REST API.')
+    parser.add_argument('-p', '--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.,
+                        help='mean seconds added to every request')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='upload bandwidth per request in MB/s '
+                        '(0 is unlimited)')
+    parser.add_argument('--error-rate', type=float, default=0.,
+                        help='fraction of requests answered with 503')
+    parser.add_argument('--late-error-rate', type=float, default=0.,
+                        help='fraction of requests answered with 502 after '
+                        'they were processed')
+    args = parser.parse_args()
+
+    server = FakeHydroShare(('127.0.0.1', args.port), args.latency,
+                            args.bandwidth * 2**20, args.error_rate,
+                            late_error_rate=args.late_error_rate)
+    print('Serving fake HydroShare on http://127.0.0.1:%d/hsapi/'
+          % args.port)
+    server.serve_forever()
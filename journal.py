@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+
+import os
+import json
+import time
+import threading
+
+
+class Journal(object):
+    """
+    Append-only record of the steps completed for each resource in a run.
+    Every entry is flushed and fsync'd before record() returns so that
+    the journal survives the process being killed.  Entries are keyed by
+    the template sheet the resource was read from and the step name.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            self.load()
+        self.fd = open(path, 'a')
+
+        # terminate a line left incomplete by an interrupted run
+        if self.fd.tell() > 0:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self.fd.write('\n')
+
+    def load(self):
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a partially written line from an interrupted run
+                    continue
+                self._add(entry['key'], entry['step'], entry.get('value'))
+
+    def record(self, key, step, value=None):
+        entry = dict(time=time.time(), key=key, step=step, value=value)
+        with self.lock:
+            self.fd.write(json.dumps(entry) + '\n')
+            self.fd.flush()
+            os.fsync(self.fd.fileno())
+            self._add(key, step, value)
+
+    def _add(self, key, step, value):
+        if step == 'deleted':
+            # the resource was removed, anything done for it must be redone
+            self.entries[key] = {}
+        else:
+            self.entries.setdefault(key, {})[step] = value
+
+    def completed(self, key):
+        """
+        Returns a dict of the steps recorded for key and their values.
+        """
+        with self.lock:
+            return dict(self.entries.get(key, {}))
+
+    def resources(self):
+        """
+        Returns a dict of resource ids created in this run keyed by
+        resource key.
+        """
+        with self.lock:
+            return {k: v['create'] for k, v in self.entries.items()
+                    if v.get('create') is not None}
+
+    def close(self):
+        self.fd.close()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+"""
+Reads resources from a normalized manifest instead of a template
+workbook.  A manifest is a directory holding one table per kind of
+record, each in CSV, JSONL or Parquet format:
+
+  resources         resource_key, title, abstract, keywords, type,
+                    sharing_status, shareable, resource_id
+  files             resource_key, uid, path, type, unzip
+  file_metadata     resource_key, uid, title, start_dt, end_dt, location,
+                    coverage, spatial_def
+  authors           resource_key, name, organization, email, address,
+                    phone
+  custom_metadata   resource_key, key, value
+
+Only the resources table is required.  The tables are read as streams
+and joined on resource_key, so the rows of every other table must be
+grouped by resource_key in the same order as the resources table, e.g.
+as produced by ORDER BY on the exporting query.  resource_id, if given,
+is the existing resource that --sync updates.
+"""
+
+import os
+import csv
+import json
+import time
+import metrics
+from resource import Resource, File, FileMetadata, Author
+
+formats = ('.csv', '.jsonl', '.parquet')
+child_tables = ('files', 'file_metadata', 'authors', 'custom_metadata')
+
+
+def _read_csv(path):
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            yield row
+
+
+def _read_jsonl(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip() != '':
+                yield json.loads(line)
+
+
+def _read_parquet(path):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise Exception('pyarrow is required to read Parquet manifests')
+    for batch in pq.ParquetFile(path).iter_batches():
+        for row in batch.to_pylist():
+            yield row
+
+
+readers = {'.csv': _read_csv,
+           '.jsonl': _read_jsonl,
+           '.parquet': _read_parquet}
+
+
+def find_table(directory, name):
+    for ext in formats:
+        path = os.path.join(directory, name + ext)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def read_table(directory, name):
+    path = find_table(directory, name)
+    if path is None:
+        return iter(())
+    return readers[os.path.splitext(path)[1]](path)
+
+
+def _bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'y')
+    return bool(value)
+
+
+def _str(value):
+    return '' if value is None else str(value)
+
+
+def _keywords(value):
+    if isinstance(value, (list, tuple)):
+        return [k.strip() for k in value if k.strip() != '']
+    return [k.strip() for k in _str(value).split(',') if k.strip() != '']
+
+
+class _Group(object):
+    """
+    Hands out the consecutive rows of a table that share a resource key.
+    """
+
+    def __init__(self, name, rows):
+        self.name = name
+        self.rows = rows
+        self.next = next(self.rows, None)
+
+    def take(self, key, seen):
+        group = []
+        while self.next is not None and \
+                _str(self.next['resource_key']) == key:
+            group.append(self.next)
+            self.next = next(self.rows, None)
+        if self.next is not None and \
+                _str(self.next['resource_key']) in seen:
+            raise Exception('%s rows for resource_key %s are not in the '
+                            'order of the resources table'
+                            % (self.name, self.next['resource_key']))
+        return group
+
+
+def iter_manifest(directory):
+    """
+    Yields a Resource for each row of the resources table, joined with
+    the rows of the other tables that share its resource_key.
+    """
+    print('Reading manifest data')
+    if find_table(directory, 'resources') is None:
+        raise Exception('Could not find a resources table in %s'
+                        % directory)
+
+    groups = {name: _Group(name, read_table(directory, name))
+              for name in child_tables}
+
+    seen = set()
+    for row in read_table(directory, 'resources'):
+        st = time.time()
+        key = _str(row['resource_key'])
+        seen.add(key)
+        files = [File(uid=_str(f.get('uid')),
+                      path=_str(f.get('path')),
+                      type=_str(f.get('type')),
+                      unzip=_bool(f.get('unzip', False)))
+                 for f in groups['files'].take(key, seen)]
+        file_meta = [FileMetadata(uid=_str(f.get('uid')),
+                                  title=_str(f.get('title')),
+                                  start_dt=_str(f.get('start_dt')),
+                                  end_dt=_str(f.get('end_dt')),
+                                  location=_str(f.get('location')),
+                                  coverage=_str(f.get('coverage')),
+                                  spatial_def=_str(f.get('spatial_def')))
+                     for f in groups['file_metadata'].take(key, seen)]
+        authors = [Author(name=_str(a.get('name')),
+                          organization=_str(a.get('organization')),
+                          email=_str(a.get('email')),
+                          address=_str(a.get('address')),
+                          phone=_str(a.get('phone')))
+                   for a in groups['authors'].take(key, seen)]
+        custom = groups['custom_metadata'].take(key, seen)
+        custom_metadata = {_str(c['key']): _str(c.get('value'))
+                           for c in custom}
+
+        r = Resource(_str(row.get('title')),
+                     _str(row.get('abstract')),
+                     _keywords(row.get('keywords')),
+                     _str(row.get('type')),
+                     files,
+                     _str(row.get('sharing_status')) or 'private',
+                     _bool(row.get('shareable', False)),
+                     authors, custom_metadata, file_meta, sheet=key,
+                     resid=_str(row.get('resource_id')) or None)
+        metrics.record('parse', time.time() - st, sheet=key)
+        yield r
+
+    for g in groups.values():
+        if g.next is not None:
+            raise Exception('%s rows for resource_key %s do not match any '
+                            'resource' % (g.name, g.next['resource_key']))
+    print('  %d resources read' % len(seen))
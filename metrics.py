@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+"""
+Timing events for every step of the pipeline.  Events are aggregated in
+memory for the whole run and, when a log has been opened, written as
+JSON lines as they happen.
+"""
+
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+_lock = threading.Lock()
+_log = None
+_totals = {}
+
+
+def open_log(path):
+    """
+    Starts writing every event to path as a JSON line.
+    """
+    global _log
+    with _lock:
+        _log = open(path, 'a')
+
+
+def close_log():
+    global _log
+    with _lock:
+        if _log is not None:
+            _log.close()
+        _log = None
+
+
+def record(step, elapsed, outcome='ok', nbytes=0, **fields):
+    """
+    Records one timing event for step.  outcome is one of ok, error or
+    skipped.
+    """
+    event = dict(time=time.time(), step=step, elapsed=elapsed,
+                 outcome=outcome, bytes=nbytes)
+    event.update(fields)
+    with _lock:
+        t = _totals.setdefault((step, outcome), dict(count=0, seconds=0.,
+                                                     bytes=0))
+        t['count'] += 1
+        t['seconds'] += elapsed
+        t['bytes'] += nbytes
+        if _log is not None:
+            _log.write(json.dumps(event, default=str) + '\n')
+            _log.flush()
+
+
+@contextmanager
+def timed(step, nbytes=0, **fields):
+    """
+    Times the enclosed block as step, recording an error outcome if it
+    raises.
+    """
+    st = time.time()
+    try:
+        yield
+    except Exception as e:
+        record(step, time.time() - st, 'error', nbytes, error=str(e),
+               **fields)
+        raise
+    record(step, time.time() - st, 'ok', nbytes, **fields)
+
+
+def totals():
+    """
+    Returns the aggregated count, seconds and bytes of every step keyed
+    by (step, outcome).
+    """
+    with _lock:
+        return {k: dict(v) for k, v in _totals.items()}
+
+
+def report():
+    """
+    Prints the time and bytes spent in each step.
+    """
+    print('\n' + 50*'-')
+    print('Step Timings')
+    print(50*'-')
+    print('  %-14s %-8s %7s %11s %10s' % ('step', 'outcome', 'count',
+                                          'seconds', 'MB'))
+    for (step, outcome), v in sorted(totals().items()):
+        print('  %-14s %-8s %7d %11.2f %10.2f'
+              % (step, outcome, v['count'], v['seconds'],
+                 v['bytes'] / 2.**20))
+
+
+def prometheus():
+    """
+    Returns the aggregated events in the Prometheus text exposition
+    format.
+    """
+    lines = ['# HELP hs_bulk_step_seconds Time spent in each pipeline step.',
+             '# TYPE hs_bulk_step_seconds summary']
+    t = totals()
+    for (step, outcome), v in sorted(t.items()):
+        labels = '{step="%s",outcome="%s"}' % (step, outcome)
+        lines.append('hs_bulk_step_seconds_count%s %d' % (labels,
+                                                           v['count']))
+        lines.append('hs_bulk_step_seconds_sum%s %f' % (labels,
+                                                         v['seconds']))
+    lines += ['# HELP hs_bulk_step_bytes_total Bytes transferred by each '
+              'pipeline step.',
+              '# TYPE hs_bulk_step_bytes_total counter']
+    for (step, outcome), v in sorted(t.items()):
+        if v['bytes'] > 0:
+            lines.append('hs_bulk_step_bytes_total{step="%s",outcome="%s"} '
+                          '%d' % (step, outcome, v['bytes']))
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path):
+    with open(path, 'w') as f:
+        f.write(prometheus())
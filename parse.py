@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 
 
-import xlrd
-from resource import Resource
+from resource import Resource, File, FileMetadata, Author, stat_cache
+import metrics
+from cache import workbook_key, sheet_keys
 from datetime import datetime as dt
 
 datemode = None
@@ -10,17 +11,23 @@ datemode = None
 valid_sections = ('General Metadata', 'Sharing Status',
                   'Resource Content', 'File Metadata',
                   'Science Metadata', 'Resource Metadata')
+section_names = frozenset(valid_sections)
 
 
 def validate(resources):
 
     print('Validating data')
+
+    # check all referenced files at once rather than one resource at a time
+    stat_cache.prefetch([f['path'] for r in resources for f in r.files])
+
     failed = []
     for r in resources:
         if not r.isvalid():
             failed.append(r)
     print('  %d resources are valid' % (len(resources) - len(failed)))
     print('  %d resources are NOT valid' % len(failed))
+    print('  %d bytes to upload' % sum(r.upload_bytes for r in resources))
 
     if len(failed) > 0:
         print('Some components of the template failed validation.')
@@ -32,154 +39,211 @@ def validate(resources):
     return failed
 
 
-def get_value(sheet, row, col):
+def iter_valid(resources, failed):
+    """
+    Validates resources one at a time as they are produced, yielding the
+    valid ones and appending the invalid ones to failed.
+    """
+    for r in resources:
+        if r.isvalid():
+            yield r
+        else:
+            print('\nResource: %s is NOT valid and will be skipped' % r.title)
+            print(50*'-')
+            r.display_errors()
+            failed.append(r)
+
+
+def convert_value(value, value_type):
 
     if datemode is None:
         raise Exception('Date mode has not been set')
 
-    value_type = sheet.cell_type(rowx=row, colx=col)
-    value = sheet.cell_value(rowx=row, colx=col)
+    import xlrd
     if value_type == xlrd.XL_CELL_DATE:
         return dt(*xlrd.xldate_as_tuple(value, datemode)).isoformat()
     else:
         return value
 
 
+def get_value(sheet, row, col):
+    return convert_value(sheet.cell_value(rowx=row, colx=col),
+                         sheet.cell_type(rowx=row, colx=col))
+
+
 def get_section_ranges(sheet):
     """
     This function returns the row ranges for each section in
-    each sheet of the template.
+    each sheet of the template, found by searching the values of
+    the first column for the section headers.  A section ends at
+    the row before the next header, less any trailing rows without
+    a value in the second column, which holds the title, path, file
+    id, author name or key of every row that is read.
     """
-    conseq_blank = 0
-    row = 0
-    sections = {}
-    current_section = None
-    while 1:
-        try:
-            value = get_value(sheet, row, 0)
-        except Exception:
-            sections[current_section]['end'] = row
-            break
-
-        # track the number of consecutive blank lines
-        conseq_blank = conseq_blank + 1 if value == '' else 0
-
-        if value in valid_sections:
-
-            # save the current section info
-            sections[value] = dict(start=row+2, end=None)
+    column = sheet.col_values(0)
+    keys = sheet.col_values(1) if sheet.ncols > 1 else [''] * len(column)
 
-            # set the end row for the previous section
-            if current_section is not None:
-                sections[current_section]['end'] = row-2
+    headers = [(row, value) for row, value in enumerate(column)
+               if value in section_names]
 
-            # change the current section
-            current_section = value
+    sections = {}
+    ends = [row for row, name in headers[1:]] + [len(column)]
+    for (row, name), end in zip(headers, ends):
+        section = sections[name] = dict(start=row+2, end=end)
+        while section['end'] > section['start'] and \
+                keys[section['end']-1] == '':
+            section['end'] -= 1
+    return sections
 
-        row += 1
 
-    return sections
+def parse_template(template, cache=None):
+    return list(iter_template(template, cache))
 
 
-def parse_template(template):
+def _open_workbook(template):
     global datemode
+    # xlrd is only loaded once a workbook is read, so manifests and cached
+    # templates do not need it
+    import xlrd
+    with metrics.timed('open_workbook', template=template):
+        data = xlrd.open_workbook(template, on_demand=True)
+    datemode = data.datemode
+    return data
 
-    print('Parsing template data')
 
-    resources = []
-    data = xlrd.open_workbook(template)
-    datemode = data.datemode
+def iter_template(template, cache=None):
+    """
+    Yields a Resource for each sheet of the template as soon as that sheet
+    has been read.  Sheets are loaded on demand and released once parsed,
+    so memory use does not grow with the size of the workbook (xlrd only
+    supports on-demand loading for .xls workbooks).
+
+    With a cache.TemplateCache, sheets are parsed and validated once and
+    read from the cache while they are unchanged.  A workbook that has not
+    changed at all is not opened.
+    """
+    print('Parsing template data')
 
-    for i in range(data.nsheets):
-        sheet = data.sheet_by_index(i)
-
-        # skip the __vocab sheet
-        if sheet.name[0:2] == '__':
-            print('  sheet %d: skipped' % i)
-            continue
-
-        print('  sheet %d: read' % i)
-        # get section ranges
-        sections = get_section_ranges(sheet)
-
-        # general metadata
-        rs = sections['General Metadata']['start']
-        resource_title = sheet.cell_value(rowx=rs, colx=1)
-        abstract = sheet.cell_value(rowx=rs+1, colx=1)
-        keywords = [k.strip() for k in
-                    sheet.cell_value(rowx=rs+2, colx=1).split()
-                    if k != '']
-        resource_type = sheet.cell_value(rowx=rs+3, colx=1)
-        sharing_status = sheet.cell_value(rowx=rs+4, colx=1)
-        shareable = sheet.cell_value(rowx=rs+5, colx=1)
-
-        # resource content
-        files = []
-        rs = sections['Resource Content']['start']
-        re = sections['Resource Content']['end']
-        for row in range(rs, re):
-            uid = sheet.cell_value(rowx=row, colx=0)
-            path = sheet.cell_value(rowx=row, colx=1)
-            type = sheet.cell_value(rowx=row, colx=7)
-            unzip = sheet.cell_value(rowx=row, colx=9)
-            if path != '':
-                files.append(dict(uid=uid, path=path, type=type, unzip=unzip))
-
-        # file metadata
-        file_meta = []
-        rs = sections['File Metadata']['start']
-        re = sections['File Metadata']['end']
-        for row in range(rs, re):
-            uid = sheet.cell_value(rowx=row, colx=1)
-            title = sheet.cell_value(rowx=row, colx=5)
-            start_dt = get_value(sheet, row, 7)
-            end_dt = get_value(sheet, row, 8)
-            location = sheet.cell_value(rowx=row, colx=9)
-            coverage = sheet.cell_value(rowx=row, colx=11)
-            spatial_def = sheet.cell_value(rowx=row, colx=13)
-            if uid != '':
-                value = get_value(sheet, row, 7)
-                file_meta.append(dict(uid=uid,
-                                 title=title,
-                                 start_dt=start_dt,
-                                 end_dt=end_dt,
-                                 location=location,
-                                 coverage=coverage,
-                                 spatial_def=spatial_def))
-
-        # science metadata
-        authors = []
-        rs = sections['Science Metadata']['start']
-        re = sections['Science Metadata']['end']
-        for row in range(rs, re):
-            name = sheet.cell_value(rowx=row, colx=1)
-            org = sheet.cell_value(rowx=row, colx=3)
-            email = sheet.cell_value(rowx=row, colx=5)
-            addr = sheet.cell_value(rowx=row, colx=7)
-            phone = sheet.cell_value(rowx=row, colx=11)
-
-            # save author metadata if provided.
-            if name != '':
-                authors.append(dict(name=name,
-                                    organization=org,
-                                    email=email,
-                                    address=addr,
-                                    phone=phone))
-
-        # extended custom metadata
-        custom_metadata = {}
-        rs = sections['Resource Metadata']['start']
-        re = sections['Resource Metadata']['end']
-        for row in range(rs, re):
-            key = sheet.cell_value(rowx=row, colx=1)
-
-            if key != '':
-                value = get_value(sheet, row, 3)
-                custom_metadata[key] = value
-
-        r = Resource(resource_title, abstract, keywords, resource_type, files,
-                     sharing_status, shareable, authors,
-                     custom_metadata, file_meta)
-        resources.append(r)
-
-    return resources
+    data = None
+    sheets = None
+    if cache is not None:
+        wbkey = workbook_key(template)
+        sheets = cache.get(wbkey)
+    cached = sheets is not None
+
+    try:
+        if not cached:
+            data = _open_workbook(template)
+            keys = sheet_keys(data, wbkey) if cache is not None \
+                else [None] * data.nsheets
+            sheets = list(zip(range(data.nsheets), data.sheet_names(), keys))
+
+        for i, name, key in sheets:
+            # skip the __vocab sheet
+            if name[0:2] == '__':
+                print('  sheet %d: skipped' % i)
+                continue
+
+            r = cache.get(key) if cache is not None else None
+            if r is not None:
+                print('  sheet %d: read from cache' % i)
+                metrics.record('parse', 0, 'skipped', sheet=name)
+                yield r
+                continue
+
+            if data is None:
+                data = _open_workbook(template)
+            sheet = data.sheet_by_index(i)
+            print('  sheet %d: read' % i)
+            with metrics.timed('parse', sheet=name):
+                r = parse_sheet(sheet)
+            data.unload_sheet(i)
+            if cache is not None:
+                r.isvalid()
+                cache.put(key, r)
+            yield r
+
+        if cache is not None and not cached:
+            cache.put(wbkey, sheets)
+    finally:
+        if data is not None:
+            data.release_resources()
+
+
+def _columns(sheet, section, cols):
+    # the values of some columns over the rows of a section, read a column
+    # at a time
+    rs, re = section['start'], section['end']
+    if re <= rs:
+        return [[] for c in cols]
+    return [sheet.col_values(c, rs, re) if c < sheet.ncols
+            else [''] * (re - rs) for c in cols]
+
+
+def _converted(sheet, row, col):
+    # cell types are only read for the cells that may hold dates
+    if col >= sheet.ncols:
+        return ''
+    return convert_value(sheet.cell_value(row, col),
+                         sheet.cell_type(row, col))
+
+
+def parse_sheet(sheet):
+    # get section ranges
+    sections = get_section_ranges(sheet)
+
+    # general metadata
+    rs = sections['General Metadata']['start']
+    resource_title = sheet.cell_value(rowx=rs, colx=1)
+    abstract = sheet.cell_value(rowx=rs+1, colx=1)
+    keywords = [k.strip() for k in
+                sheet.cell_value(rowx=rs+2, colx=1).split()
+                if k != '']
+    resource_type = sheet.cell_value(rowx=rs+3, colx=1)
+    sharing_status = sheet.cell_value(rowx=rs+4, colx=1)
+    shareable = sheet.cell_value(rowx=rs+5, colx=1)
+
+    # resource content
+    files = []
+    for uid, path, ftype, unzip in zip(*_columns(
+            sheet, sections['Resource Content'], (0, 1, 7, 9))):
+        if path != '':
+            # positional arguments, which are noticeably cheaper for the
+            # many rows of large templates
+            files.append(File(uid, path, ftype, unzip))
+
+    # file metadata
+    file_meta = []
+    section = sections['File Metadata']
+    for row, (uid, title, location, coverage, spatial_def) in enumerate(
+            zip(*_columns(sheet, section, (1, 5, 9, 11, 13))),
+            section['start']):
+        if uid != '':
+            file_meta.append(FileMetadata(uid=uid,
+                                          title=title,
+                                          start_dt=_converted(sheet, row, 7),
+                                          end_dt=_converted(sheet, row, 8),
+                                          location=location,
+                                          coverage=coverage,
+                                          spatial_def=spatial_def))
+
+    # science metadata
+    authors = []
+    for name, org, email, addr, phone in zip(*_columns(
+            sheet, sections['Science Metadata'], (1, 3, 5, 7, 11))):
+
+        # save author metadata if provided.
+        if name != '':
+            authors.append(Author(name, org, email, addr, phone))
+
+    # extended custom metadata
+    custom_metadata = {}
+    section = sections['Resource Metadata']
+    for row, (key,) in enumerate(zip(*_columns(sheet, section, (1,))),
+                                 section['start']):
+        if key != '':
+            custom_metadata[key] = _converted(sheet, row, 3)
+
+    return Resource(resource_title, abstract, keywords, resource_type, files,
+                    sharing_status, shareable, authors,
+                    custom_metadata, file_meta, sheet=sheet.name)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+"""
+Dry-run capacity planning: the API calls and bytes needed by every
+resource, an estimate of the wall-clock time of the whole load and an
+order of the resources that keeps that time short.
+"""
+
+import json
+import heapq
+from collections import Counter
+import create
+import scheduler
+import upload
+
+# used when no measurements are available
+default_latency = 0.5
+default_bandwidth = 10 * 2**20
+
+# steps that are a single API call without a significant body
+_call_steps = ('create', 'sharing', 'shareable', 'scimeta', 'unzip',
+               'filetype', 'filemeta')
+
+
+def _quiet(msg, end='\n'):
+    pass
+
+
+def resource_steps(resource, bundle_threshold=0, **options):
+    """
+    Returns the steps that would be run to create resource.  Each step
+    issues exactly one API call.  options are those of create_many that
+    change the steps, e.g. compressor.
+    """
+    return create.build_steps(None, resource, _quiet,
+                              bundle_threshold=bundle_threshold, **options)
+
+
+def step_time(step, latency, bandwidth):
+    return latency + step.nbytes / float(bandwidth)
+
+
+def resource_time(steps, latency, bandwidth, workers=4):
+    """
+    Simulates scheduler.run with the given number of step workers and
+    returns the estimated seconds needed to run all of steps.
+    """
+    pending = list(steps)
+    finished = set()
+    running = []
+    now = 0.
+    while pending or running:
+        ready = [s for s in pending
+                 if all(req in finished for req in s.requires)]
+        ready.sort(key=scheduler.priority)
+        for s in ready[:workers - len(running)]:
+            pending.remove(s)
+            heapq.heappush(running, (now + step_time(s, latency, bandwidth),
+                                     s.name))
+        now, name = heapq.heappop(running)
+        finished.add(name)
+    return now
+
+
+def longest_first(durations, workers):
+    """
+    Orders jobs longest first and assigns each to the least loaded of
+    workers, which is how create_many hands out resources.  durations is
+    a list of (key, seconds).  Returns the order and the makespan.
+    """
+    order = sorted(durations, key=lambda d: -d[1])
+    loads = [0.] * max(1, workers)
+    for key, seconds in order:
+        heapq.heappush(loads, heapq.heappop(loads) + seconds)
+    return [key for key, seconds in order], max(loads)
+
+
+def calibrate(path):
+    """
+    Measures the request latency and upload bandwidth from the --metrics
+    log of a previous run.  Either is None if the log has no events for
+    it.
+    """
+    latencies = []
+    nbytes = 0
+    start = end = None
+    with open(path) as f:
+        for line in f:
+            try:
+                e = json.loads(line)
+            except ValueError:
+                continue
+            if e.get('outcome') != 'ok':
+                continue
+            if e['step'] in _call_steps:
+                latencies.append(e['elapsed'])
+            elif e['step'] == 'upload' and e['bytes'] > 0:
+                nbytes += e['bytes']
+                st = e['time'] - e['elapsed']
+                start = st if start is None else min(start, st)
+                end = e['time'] if end is None else max(end, e['time'])
+
+    latency = None
+    if len(latencies) > 0:
+        latency = sorted(latencies)[len(latencies) // 2]
+    bandwidth = None
+    if nbytes > 0 and end > start:
+        bandwidth = nbytes / (end - start)
+    return latency, bandwidth
+
+
+def plan(resources, workers=1, step_workers=4, latency=default_latency,
+         bandwidth=default_bandwidth, rate=20, bundle_threshold=0,
+         **options):
+    """
+    Estimates the calls, bytes and time of every resource and of the
+    whole load.  bandwidth is the total upload bandwidth in bytes/s and
+    rate the maximum requests per second.  The resources are returned in
+    the order that minimizes the estimated makespan.  Files that would
+    be compressed, with a compressor in options, count at their full
+    size since the size of their archives is not known in advance.
+    """
+    items = []
+    for r in resources:
+        steps = resource_steps(r, bundle_threshold, **options)
+        items.append(dict(resource=r,
+                          calls=Counter(s.name.split(':')[0] for s in steps),
+                          bytes=sum(s.nbytes for s in steps),
+                          seconds=resource_time(steps, latency, bandwidth,
+                                                step_workers)))
+
+    order, makespan = longest_first([(i, item['seconds'])
+                                     for i, item in enumerate(items)],
+                                    workers)
+    calls = sum((item['calls'] for item in items), Counter())
+    nbytes = sum(item['bytes'] for item in items)
+
+    # the load can be no faster than the shared upload bandwidth or the
+    # request rate allow
+    bounds = {'latency': makespan,
+              'bandwidth': nbytes / float(bandwidth),
+              'rate': sum(calls.values()) / float(rate)}
+    limit = max(bounds, key=bounds.get)
+    return dict(resources=[items[i] for i in order],
+                calls=calls,
+                bytes=nbytes,
+                seconds=bounds[limit],
+                limit=limit,
+                latency=latency,
+                bandwidth=bandwidth,
+                workers=workers,
+                compressed=options.get('compressor') is not None)
+
+
+def order(resources, **options):
+    """
+    Returns resources ordered longest first, see plan().
+    """
+    return [item['resource'] for item in plan(resources,
+                                              **options)['resources']]
+
+
+def _duration(seconds):
+    if seconds < 60:
+        return '%.1f s' % seconds
+    h, rem = divmod(int(round(seconds)), 3600)
+    return '%d:%02d:%02d' % (h, rem // 60, rem % 60)
+
+
+def report(result):
+    print('\n' + 50*'-')
+    print('Load Plan')
+    print(50*'-')
+    print('  %-24s %6s %10s %10s' % ('resource', 'calls', 'size',
+                                     'est. time'))
+    for item in result['resources']:
+        r = item['resource']
+        print('  %-24s %6d %10s %10s'
+              % ((r.sheet or r.title)[:24], sum(item['calls'].values()),
+                 upload.format_bytes(item['bytes']),
+                 _duration(item['seconds'])))
+
+    print('\n  API calls:')
+    for kind, n in sorted(result['calls'].items()):
+        print('    %-12s %8d' % (kind, n))
+    print('    %-12s %8d' % ('total', sum(result['calls'].values())))
+    print('\n  bytes to upload:    %s' % upload.format_bytes(result['bytes']))
+    if result.get('compressed'):
+        print('                      (compressed files at full size)')
+    print('  request latency:    %.3f s' % result['latency'])
+    print('  upload bandwidth:   %s/s'
+          % upload.format_bytes(result['bandwidth']))
+    print('  resource workers:   %d' % result['workers'])
+    print('  estimated time:     %s (limited by %s)'
+          % (_duration(result['seconds']), result['limit']))
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+"""
+Retry, backoff and rate limiting applied to every HydroShare API call.
+"""
+
+import time
+import random
+import threading
+import metrics
+
+# responses that indicate the server is overloaded or briefly unavailable
+transient_status = (429, 502, 503, 504)
+
+# responses sent instead of processing the request
+rejected_status = (429, 503)
+
+
+def is_transient(e):
+    # imported here so that planning and validation do not load the client
+    import requests
+    from hs_restclient import HydroShareHTTPException
+    if isinstance(e, (requests.exceptions.ConnectionError,
+                      requests.exceptions.Timeout)):
+        return True
+    if isinstance(e, HydroShareHTTPException):
+        return e.status_code in transient_status
+    return False
+
+
+def is_rejected(e):
+    """
+    True if the request certainly did not reach the application, so that
+    even a call that creates something may be repeated.  Gateway errors,
+    timeouts and dropped connections may follow a request that was
+    processed.
+    """
+    import requests
+    from hs_restclient import HydroShareHTTPException
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(e, HydroShareHTTPException):
+        return e.status_code in rejected_status
+    return False
+
+
+def retry_after(e):
+    """
+    Returns the delay in seconds requested by a 429/503 response, if any.
+    """
+    from hs_restclient import HydroShareHTTPException
+    if isinstance(e, HydroShareHTTPException):
+        response = e.args[0] if len(e.args) > 0 else None
+        headers = getattr(response, 'headers', None) or {}
+        try:
+            return float(headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            pass
+    return None
+
+
+class TokenBucket(object):
+    """
+    Limits requests to rate per second with bursts of up to burst
+    requests.  The rate adapts to the server: it is halved when the
+    server reports it is overloaded and recovers slowly on success.
+    """
+
+    def __init__(self, rate, burst=None, min_rate=0.5):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = min(min_rate, self.rate)
+        self.burst = float(burst or max(1, rate))
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def slow_down(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def speed_up(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class CircuitBreaker(object):
+    """
+    Opens after threshold consecutive transient failures, pausing every
+    new request for cooldown seconds so that a struggling server gets a
+    chance to recover, then lets requests through again.
+    """
+
+    def __init__(self, threshold=5, cooldown=30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            delay = self.open_until - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            opened = self.failures >= self.threshold
+            if opened:
+                self.open_until = time.time() + self.cooldown
+                self.failures = 0
+        if opened:
+            # imported here, create imports this module
+            import create
+            with create._print_lock:
+                print('  server is struggling, pausing requests for %g '
+                      'seconds' % self.cooldown, flush=True)
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+
+
+class RequestPolicy(object):
+    """
+    Issues calls through a rate limiter and circuit breaker, retrying
+    transient failures with jittered exponential backoff.  Any other
+    error is raised immediately.
+    """
+
+    def __init__(self, rate=20, burst=None, retries=5, backoff=1.,
+                 max_backoff=60., breaker_threshold=5, breaker_cooldown=30):
+        self.bucket = TokenBucket(rate, burst)
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def delay(self, attempt, e=None):
+        requested = retry_after(e)
+        if requested is not None:
+            return min(requested, self.max_backoff)
+        cap = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return random.uniform(0, cap)
+
+    def call(self, func, *args, idempotent=True, recover=None, **kwargs):
+        """
+        Calls func, retrying transient failures.  Calls that are not
+        idempotent are only retried when the server rejected them, or
+        when recover, called with the error, returns None to report that
+        the call had no effect.  Any other value recover returns is taken
+        as the result of the call.
+        """
+        attempt = 1
+        while True:
+            self.breaker.wait()
+            self.bucket.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if not is_transient(e):
+                    raise
+                self.breaker.failure()
+                self.bucket.slow_down()
+                if not (idempotent or is_rejected(e)):
+                    if recover is None:
+                        raise
+                    result = recover(e)
+                    if result is not None:
+                        return result
+                if attempt > self.retries:
+                    raise
+                delay = self.delay(attempt, e)
+                metrics.record('retry', delay, 'error', error=str(e),
+                               attempt=attempt)
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self.breaker.success()
+            self.bucket.speed_up()
+            return result
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
 import os
-from tabulate import tabulate
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import metrics
 
 valid_resource_types = {'compositeresource': 'CompositeResource'}
 all_resource_types = {'collectionresource': 'CollectionResource',
@@ -25,24 +27,169 @@ valid_file_types = {'netcdf': 'NetCDF',
 valid_status = ['public', 'private', 'discoverable']
 
 
+class StatCache(object):
+    """
+    Size and modification time of local files, shared by every resource
+    so that each path is stat'ed once per run no matter how many
+    resources reference it or how often they are validated.
+    """
+
+    def __init__(self):
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def _stat(self, path):
+        try:
+            st = os.stat(path)
+            value = (st.st_size, st.st_mtime)
+        except OSError:
+            value = None
+        with self.lock:
+            self.stats[path] = value
+        return value
+
+    def stat(self, path):
+        """
+        Returns (size, mtime) for path, or None if it does not exist.
+        """
+        with self.lock:
+            if path in self.stats:
+                return self.stats[path]
+        return self._stat(path)
+
+    def size(self, path):
+        st = self.stat(path)
+        return st[0] if st is not None else 0
+
+    def prefetch(self, paths, workers=16):
+        """
+        Stats every path not already cached using a pool of threads,
+        which hides the latency of network file systems.
+        """
+        with self.lock:
+            todo = set(p for p in paths if p not in self.stats)
+        if len(todo) == 0:
+            return
+        with ThreadPoolExecutor(max_workers=min(workers, len(todo))) as pool:
+            list(pool.map(self._stat, todo))
+
+    def clear(self):
+        with self.lock:
+            self.stats = {}
+
+
+stat_cache = StatCache()
+
+
+class Record(object):
+    """
+    Compact record with a fixed set of fields that can also be used like
+    the dict it replaces, e.g. f['path'] or dict(f).  Subclasses assign
+    their fields directly in __init__, which keeps building a record
+    about as cheap as building a dict.
+    """
+
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.__slots__ \
+            else default
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def values(self):
+        return [getattr(self, k) for k in self.__slots__]
+
+    def items(self):
+        return [(k, getattr(self, k)) for k in self.__slots__]
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__,
+                           ', '.join('%s=%r' % kv for kv in self.items()))
+
+
+class File(Record):
+    __slots__ = ('uid', 'path', 'type', 'unzip', 'metadata')
+
+    def __init__(self, uid=None, path=None, type=None, unzip=None,
+                 metadata=None):
+        self.uid = uid
+        self.path = path
+        self.type = type
+        self.unzip = unzip
+        self.metadata = metadata
+
+
+class FileMetadata(Record):
+    __slots__ = ('uid', 'title', 'start_dt', 'end_dt', 'location',
+                 'coverage', 'spatial_def')
+
+    def __init__(self, uid=None, title=None, start_dt=None, end_dt=None,
+                 location=None, coverage=None, spatial_def=None):
+        self.uid = uid
+        self.title = title
+        self.start_dt = start_dt
+        self.end_dt = end_dt
+        self.location = location
+        self.coverage = coverage
+        self.spatial_def = spatial_def
+
+
+class Author(Record):
+    __slots__ = ('name', 'organization', 'email', 'address', 'phone')
+
+    def __init__(self, name=None, organization=None, email=None,
+                 address=None, phone=None):
+        self.name = name
+        self.organization = organization
+        self.email = email
+        self.address = address
+        self.phone = phone
+
+
 class Resource(object):
 
+    __slots__ = ('title', 'abstract', 'keywords', 'type', 'files',
+                 'sharing_status', 'shareable', 'authors',
+                 'custom_metadata', 'filemeta', 'sheet', 'resid',
+                 'upload_bytes', 'validation_text', 'file_stats')
+
     def __init__(self, title, abstract, keywords, type,
-                 files=[], sharing_status='private', 
-                 shareable="false", authors=[],
-                 custom_metadata={}, file_metadata=[]):
+                 files=None, sharing_status='private',
+                 shareable="false", authors=None,
+                 custom_metadata=None, file_metadata=None, sheet=None,
+                 resid=None):
         self.title = title
         self.abstract = abstract
         self.keywords = keywords
         self.type = type
-        self.files = files
+        self.files = files if files is not None else []
         self.sharing_status = sharing_status
         self.shareable = shareable
 #        self.unzip_files = unzip_files
-        self.authors = authors
-        self.custom_metadata = custom_metadata
-        self.filemeta = file_metadata
+        self.authors = authors if authors is not None else []
+        self.custom_metadata = custom_metadata \
+            if custom_metadata is not None else {}
+        self.filemeta = file_metadata if file_metadata is not None else []
+        self.sheet = sheet
+        self.resid = resid
+        self.upload_bytes = 0
         self.validation_text = []
+        self.file_stats = None
 
     def __validate(self):
         self.validation_text = []
@@ -79,15 +226,22 @@ class Resource(object):
 
         if type(self.files) != list:
             self.validation_text.append('Files must be a list')
+        stat_cache.prefetch([f['path'] for f in self.files])
+        self.upload_bytes = 0
         for f in self.files:
-            if not os.path.exists(f['path']):
+            st = stat_cache.stat(f['path'])
+            if st is None:
                 self.validation_text.append('Could not find file: %s'
                                             % f['path'])
-            if f['type'].lower() not in valid_file_types:
+            else:
+                self.upload_bytes += st[0]
+            # types are normalized by validation, None for plain files
+            ftype = f['type'] or ''
+            if ftype.lower() not in valid_file_types:
                 self.validation_text.append('%s is not a valid file type'
                                             % f['type'])
             else:
-                f['type'] = valid_file_types[f['type'].lower()]
+                f['type'] = valid_file_types[ftype.lower()]
 
         file_uids = [f['uid'] for f in self.files]
         for f in self.filemeta:
@@ -100,8 +254,10 @@ class Resource(object):
                     self.validation_text.append('invalid coverage: %s' %
                                                 f['coverage'])
                 try:
-                    spatialdef = dict(item.split('=') for item in
-                                      f['spatial_def'].split())
+                    spatialdef = f['spatial_def'] \
+                        if isinstance(f['spatial_def'], dict) else \
+                        dict(item.split('=') for item in
+                             f['spatial_def'].split())
 
                 except:
                     spatialdef = {}
@@ -118,10 +274,19 @@ class Resource(object):
                         if 'north_lat' not in spatialdef or \
                            'south_lat' not in spatialdef or \
                            'east_lon' not in spatialdef or \
-                           'west_lat' not in spatialdef:
+                           'west_lon' not in spatialdef:
                             self.validation_text.append('invalid spatial '
                                                         'definition '
                                                         'for type "box"')
+                    # coordinates are sent as numbers, a trailing comma
+                    # separating the items is allowed
+                    for k, value in spatialdef.items():
+                        try:
+                            spatialdef[k] = float(str(value).strip(','))
+                        except ValueError:
+                            self.validation_text.append(
+                                'invalid coordinate in spatial definition: '
+                                '%s=%s' % (k, value))
                 else:
                     self.validation_text.append('spatial definition is '
                                                 'required if coverage type '
@@ -136,9 +301,19 @@ class Resource(object):
 
 #                self.files['metadata'] = f
 
+    def __stats(self):
+        return [stat_cache.stat(f['path']) for f in self.files]
+
     def isvalid(self):
+        # the result of an earlier validation stands while the referenced
+        # files are unchanged
+        if self.file_stats is not None and self.file_stats == self.__stats():
+            return len(self.validation_text) == 0
+
         self.validation_text = []
-        self.__validate()
+        with metrics.timed('validate', resource=self.sheet or self.title):
+            self.__validate()
+        self.file_stats = self.__stats()
         if len(self.validation_text) == 0:
             return True
         else:
@@ -155,6 +330,7 @@ class Resource(object):
                 print(' --> %s' % e)
 
     def print_table(self, title, d, fmt='psql', headers=[]):
+        from tabulate import tabulate
         print('\n%s' % title)
         if len(d) > 0:
             if len(headers) == 0:
@@ -165,6 +341,7 @@ class Resource(object):
             print('No data')
 
     def print_multi_table(self, title, list_data, fmt='psql', headers=[]):
+        from tabulate import tabulate
         print('\n%s' % title)
         if len(headers) == 0:
             headers = list_data[0][0].keys()
@@ -188,7 +365,8 @@ class Resource(object):
                     {'k': 'Keywords', 'v': ','.join(self.keywords)},
                     {'k': 'Type', 'v': self.type},
                     {'k': 'Sharing Status', 'v': self.sharing_status},
-                    {'k': 'Sharable', 'v': self.shareable}]
+                    {'k': 'Sharable', 'v': self.shareable},
+                    {'k': 'Upload Size', 'v': '%d bytes' % self.upload_bytes}]
         self.print_table('General Metadata', gen_meta,
                          headers=['Key', 'Value'])
         files_abbv = []
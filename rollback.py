@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+"""
+Deletes the resources of a failed or unwanted run concurrently.  Run as
+a script it rolls back every resource recorded in a journal.
+"""
+
+import os
+import sys
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import create
+import dedupe
+from journal import Journal
+
+policies = ['prompt', 'delete', 'keep', 'retry-then-delete']
+
+
+def delete_resource(hs, resid):
+    """
+    Deletes a resource, retrying transient errors.  A resource that no
+    longer exists counts as deleted.
+    """
+    from hs_restclient import HydroShareNotFound
+    try:
+        create._call(hs, hs.deleteResource, resid)
+    except HydroShareNotFound:
+        pass
+
+
+def delete_many(hs, items, workers=4, journal=None, catalog=None,
+                dedupe_index=None):
+    """
+    Deletes the resources in items, a list of (key, resource id), using
+    a pool of threads.  Each deletion is recorded in the journal and
+    removed from the catalog of existing resources and the dedupe index.
+    Returns a dict of the resource ids that could not be deleted and the
+    error.
+    """
+    failed = {}
+
+    def work(item):
+        key, resid = item
+        try:
+            delete_resource(hs, resid)
+        except Exception as e:
+            print('  could not delete resource id=%s: %s' % (resid, e))
+            failed[resid] = e
+            return
+        if journal is not None:
+            journal.record(key, 'deleted', resid)
+        if catalog is not None:
+            catalog.remove(resid)
+        if dedupe_index is not None:
+            dedupe_index.forget(resid)
+        print('  deleted resource id=%s' % resid)
+
+    if len(items) > 0:
+        with ThreadPoolExecutor(max_workers=min(workers,
+                                                len(items))) as pool:
+            list(pool.map(work, items))
+    return failed
+
+
+def rollback(hs, errors, policy='prompt', workers=4, journal=None,
+             **options):
+    """
+    Applies a rollback policy to the errors returned by
+    create.create_many.  Returns the resources that were kept, as a dict
+    of title keyed by resource id, and the errors that remain.
+
+    prompt: ask whether to delete each failed resource
+    delete: delete every failed resource
+    keep: leave the failed resources as they are
+    retry-then-delete: resume the failed resources once from the
+        journal, then delete the ones that fail again
+
+    options are passed to create.create_many when retrying.
+    """
+    kept = {}
+    retried = {}
+    if policy == 'retry-then-delete' and len(errors) > 0:
+        print('  retrying %d failed resources' % len(errors))
+        retried, errors = create.create_many(
+            hs, [d['resource'] for d in errors.values()], workers=workers,
+            journal=journal, resume=True, **options)
+        for resid, title in retried.items():
+            print('  %s: succeeded on retry' % title)
+
+    delete = []
+    for r, d in errors.items():
+        print('  %s: %s.' % (d['title'], d['error']))
+        if d['id'] is None:
+            continue
+        if policy == 'keep':
+            kept[r] = d['title']
+        elif policy == 'prompt':
+            res = input('Would you like to delete it [Y/n]?')
+            if res != 'n':
+                delete.append((d['key'], r))
+            else:
+                kept[r] = d['title']
+        else:
+            delete.append((d['key'], r))
+
+    failed = delete_many(hs, delete, workers, journal,
+                         options.get('catalog'), options.get('dedupe_index'))
+    for resid in failed:
+        kept[resid] = errors[resid]['title']
+    kept.update(retried)
+    return kept, errors
+
+
+if __name__ == "__main__":
+    import requests
+    import connect
+
+    parser = argparse.ArgumentParser(description='Deletes every HydroShare '
+                                     'resource recorded in a bulk upload '
+                                     'journal.')
+    parser.add_argument('journal', help='journal file of the run')
+    parser.add_argument('-a', '--address', default='www.hydroshare.org',
+                        help='hydroshare host address')
+    parser.add_argument('-u', '--user', required=True,
+                        help='hydroshare username')
+    parser.add_argument('-s', '--no-ssl-verify', action='store_true',
+                        help='skip ssl verification')
+    parser.add_argument('--client-id',
+                        help='OAuth2 client id, authenticate with OAuth2 '
+                        'rather than basic auth')
+    parser.add_argument('--client-secret', help='OAuth2 client secret')
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='number of resources to delete in parallel')
+    parser.add_argument('-y', '--yes', action='store_true',
+                        help='do not ask for confirmation')
+    parser.add_argument('--dedupe-index', default=dedupe.default_index,
+                        help='content hash index to remove the deleted '
+                        'resources from, if it exists')
+    args = parser.parse_args()
+
+    journal = Journal(args.journal)
+    items = sorted(journal.resources().items())
+    if len(items) == 0:
+        print('No resources are recorded in %s' % args.journal)
+        sys.exit()
+
+    print('The following resources will be deleted:')
+    for key, resid in items:
+        print('  %s: %s' % (key, resid))
+    if not args.yes:
+        res = input('Delete %d resources [y/N]? ' % len(items))
+        if res.lower() != 'y':
+            sys.exit()
+
+    if args.no_ssl_verify:
+        requests.packages.urllib3.disable_warnings()
+    hs = connect.authenticate(args.user, args.address, 3,
+                              not args.no_ssl_verify,
+                              max(args.workers, connect.default_pool_size),
+                              args.client_id, args.client_secret)
+    if not hs:
+        sys.exit(1)
+    create.set_max_inflight(hs, args.workers)
+
+    index = None
+    if os.path.exists(args.dedupe_index):
+        index = dedupe.HashIndex(args.dedupe_index)
+    failed = delete_many(hs, items, args.workers, journal,
+                         dedupe_index=index)
+    journal.close()
+    print('%d resources deleted, %d failed' % (len(items) - len(failed),
+                                               len(failed)))
+    if len(failed) > 0:
+        sys.exit(1)
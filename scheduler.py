@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class Step(object):
+    """
+    A unit of work in a dependency graph.  func is called with a dict of
+    the results of all steps that have completed so far.  nbytes is the
+    amount of data the step transfers, if known.
+    """
+
+    def __init__(self, name, func, requires=(), nbytes=0):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+        self.nbytes = nbytes
+
+
+def priority(step):
+    """
+    Sort key of the steps that are ready to start.  API calls without a
+    payload go first, as they are quick and may unblock others, then
+    transfers largest first, as they finish last.
+    """
+    return (step.nbytes > 0, -step.nbytes)
+
+
+def run(steps, workers=4):
+    """
+    Executes a list of Steps, running every step whose requirements have
+    been satisfied concurrently.  If a step fails no new steps are
+    started, the steps already running are allowed to finish and the
+    first exception is re-raised.  Returns a dict of results keyed by
+    step name.
+    """
+    steps = {s.name: s for s in steps}
+    for s in steps.values():
+        for req in s.requires:
+            if req not in steps:
+                raise Exception('Step %s requires unknown step %s'
+                                % (s.name, req))
+
+    results = {}
+    pending = dict(steps)
+    running = {}
+    error = None
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            if error is None:
+                ready = [s for s in pending.values()
+                         if all(req in results for req in s.requires)]
+                ready.sort(key=priority)
+                for s in ready:
+                    del pending[s.name]
+                    running[pool.submit(s.func, dict(results))] = s.name
+
+            if not running:
+                if error is None and pending:
+                    raise Exception('Circular step dependencies: %s'
+                                    % ', '.join(pending))
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    if error is None:
+                        error = e
+
+    if error is not None:
+        raise error
+    return results
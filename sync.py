@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+
+"""
+Updates existing resources to match the template, pushing only the
+metadata and files that differ from what is on HydroShare.
+"""
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import scheduler
+from scheduler import Step
+import create
+from create import _call, _file_list, ResourceLog
+import metrics
+from resource import stat_cache
+
+
+def _file_metadata(hs, resid, path):
+    return _call(hs, hs.resource(resid).files.metadata, path).json()
+
+
+def fetch_remote(hs, resid, workers=4, fnames=()):
+    """
+    Fetches the science metadata, system metadata, custom metadata and
+    file list of a resource concurrently, then the file level metadata
+    of the files named in fnames that are in the resource.
+    """
+    def filemeta(res):
+        metadata = {}
+        for fname in fnames:
+            path = _remote_path(fname, res['files'])
+            if path is not None:
+                metadata[path] = _file_metadata(hs, resid, path)
+        return metadata
+
+    steps = [Step('scimeta',
+                  lambda res: _call(hs, hs.getScienceMetadata, resid)),
+             Step('sysmeta',
+                  lambda res: _call(hs, hs.getSystemMetadata, resid)),
+             Step('custom',
+                  lambda res: _call(hs, hs.resource(resid).scimeta.get)),
+             Step('files', lambda res: _call(hs, _file_list, hs, resid)),
+             Step('filemeta', filemeta, ['files'])]
+    return scheduler.run(steps, workers)
+
+
+def _author(a):
+    return tuple((a.get(k) or '').strip() for k in
+                 ('name', 'organization', 'email', 'address', 'phone'))
+
+
+def _sharing_status(sysmeta):
+    if sysmeta.get('public'):
+        return 'public'
+    if sysmeta.get('discoverable'):
+        return 'discoverable'
+    return 'private'
+
+
+def _remote_path(fname, remote_files):
+    # files may have been unpacked into a folder from a bundle
+    if fname in remote_files:
+        return fname
+    for path in remote_files:
+        if path.endswith('/' + fname):
+            return path
+    return None
+
+
+def _differs(wanted, remote):
+    # the server may return numbers as strings, and more fields than
+    # were set, so only the fields that were set are compared
+    if isinstance(wanted, dict):
+        if not isinstance(remote, dict):
+            return True
+        return any(_differs(v, remote.get(k)) for k, v in wanted.items())
+    if isinstance(wanted, float):
+        try:
+            return float(remote) != wanted
+        except (TypeError, ValueError):
+            return True
+    return str(wanted) != str(remote)
+
+
+def diff(resource, remote, resid=None, dedupe_index=None):
+    """
+    Compares a resource with the remote state returned by fetch_remote.
+    Files are compared by size, and by content when a dedupe index knows
+    what was uploaded to the resource.  Returns a dict of the changes:
+
+      scimeta    science metadata fields to update
+      custom     custom metadata to update
+      sharing    whether the sharing status differs
+      shareable  whether the shareable flag differs
+      new        files that are not in the resource
+      changed    (file, remote path) of files that differ
+      filemeta   (file, remote path) of unchanged files whose file level
+                 metadata differs
+      extra      remote files that are not in the template, which are
+                 left alone
+    """
+    r = resource
+    scimeta = remote['scimeta']
+
+    fields = {}
+    if r.title != scimeta.get('title'):
+        fields['title'] = r.title
+    if r.abstract != (scimeta.get('description') or ''):
+        fields['description'] = r.abstract
+    subjects = [s['value'] for s in scimeta.get('subjects') or []]
+    if sorted(r.keywords) != sorted(subjects):
+        fields['subjects'] = [{'value': k} for k in r.keywords]
+    if len(r.authors) > 0:
+        creators = sorted(scimeta.get('creators') or [],
+                          key=lambda c: c.get('order') or 0)
+        if [_author(a) for a in r.authors] != \
+                [_author(c) for c in creators]:
+            fields['creators'] = [dict(a) for a in r.authors]
+
+    remote_custom = remote['custom'] or {}
+    custom = {k: v for k, v in r.custom_metadata.items()
+              if remote_custom.get(k) != str(v)}
+
+    sysmeta = remote['sysmeta']
+    status = r.sharing_status.lower()
+    changes = dict(scimeta=fields, custom=custom,
+                   sharing=_sharing_status(sysmeta) != status,
+                   shareable=bool(sysmeta.get('shareable')) != r.shareable,
+                   new=[], changed=[], filemeta=[], extra=[])
+
+    remote_files = remote['files']
+    matched = set()
+    for f in r.files:
+        fname = os.path.basename(f['path'])
+        path = _remote_path(fname, remote_files)
+        if path is None:
+            changes['new'].append(f)
+            continue
+        matched.add(path)
+        if remote_files[path] != stat_cache.size(f['path']):
+            changes['changed'].append((f, path))
+            continue
+        if dedupe_index is not None and resid is not None:
+            uploaded = dedupe_index.uploaded(dedupe_index.digest(f['path']))
+            known = dedupe_index.filenames(resid)
+            if fname in known and (resid, fname) not in uploaded:
+                changes['changed'].append((f, path))
+                continue
+        # changed files get their metadata again once uploaded
+        if f.get('metadata') and _differs(
+                create.file_metadata(f['metadata']),
+                remote.get('filemeta', {}).get(path)):
+            changes['filemeta'].append((f, path))
+    changes['extra'] = sorted(p for p in remote_files if p not in matched)
+    return changes
+
+
+def has_changes(changes):
+    return any(changes[k] for k in ('scimeta', 'custom', 'sharing',
+                                    'shareable', 'new', 'changed',
+                                    'filemeta'))
+
+
+def describe(changes, log):
+    for field in sorted(changes['scimeta']):
+        log('  %s differs' % field)
+    for k in sorted(changes['custom']):
+        log('  custom metadata %s differs' % k)
+    if changes['sharing']:
+        log('  sharing status differs')
+    if changes['shareable']:
+        log('  shareable differs')
+    for f in changes['new']:
+        log('  new file: %s' % f['path'])
+    for f, path in changes['changed']:
+        log('  changed file: %s' % f['path'])
+    for f, path in changes['filemeta']:
+        log('  file metadata differs: %s' % f['path'])
+    for path in changes['extra']:
+        log('  not in template, left alone: %s' % path)
+
+
+def build_sync_steps(hs, resource, resid, changes, log, **options):
+    """
+    Returns the steps that push the changes, reusing the sharing and file
+    steps of create.build_steps for an existing resource id.  Changed
+    files are removed before being uploaded again.
+    """
+    # changed files are uploaded individually, never bundled
+    options['bundle_threshold'] = 0
+
+    wanted = set(k for k in ('sharing', 'shareable') if changes[k])
+    paths = set(f['path'] for f in changes['new'])
+    paths.update(f['path'] for f, _ in changes['changed'])
+
+    steps = [Step('create', lambda results: resid)]
+    for s in create.build_steps(hs, resource, log, **options):
+        if s.name in wanted or \
+                (':' in s.name and s.name.split(':', 1)[1] in paths):
+            steps.append(s)
+
+    dedupe_index = options.get('dedupe_index')
+    for f, path in changes['changed']:
+        def remove(results, path=path):
+            _call(hs, hs.deleteResourceFile, resid, path)
+            if dedupe_index is not None:
+                dedupe_index.forget(resid, os.path.basename(path))
+            log('  removing changed file: %s... done' % path)
+        name = 'remove:%s' % f['path']
+        steps.append(Step(name, remove, ['create']))
+        for s in steps:
+            if s.name == 'upload:%s' % f['path']:
+                s.requires = (name,)
+
+    for f, path in changes['filemeta']:
+        steps.append(create.build_file_metadata_step(hs, f, path, log,
+                                                     'create'))
+
+    if len(changes['scimeta']) > 0:
+        def scimeta(results):
+            _call(hs, hs.updateScienceMetadata, resid,
+                  metadata=changes['scimeta'])
+            log('  updating science metadata... done')
+        steps.append(Step('scimeta', scimeta, ['create']))
+
+    if len(changes['custom']) > 0:
+        def custom(results):
+            _call(hs, hs.resource(resid).scimeta.custom, changes['custom'])
+            log('  updating custom metadata... done')
+        steps.append(Step('custom', custom, ['create']))
+
+    return steps
+
+
+def sync_resource(hs, resource, resid, log=None, step_workers=4,
+                  dry_run=False, dedupe_index=None, **options):
+    r = resource
+    st = time.time()
+    log = log or ResourceLog()
+    key = r.sheet or r.title
+    result = {'id': resid, 'key': key, 'title': r.title, 'message': None}
+    try:
+        log('\nSyncing resource: %s (id=%s)' % (r.title, resid))
+        with metrics.timed('fetch', resource=key):
+            remote = fetch_remote(hs, resid, step_workers,
+                                  [os.path.basename(f['path'])
+                                   for f in r.files if f.get('metadata')])
+        changes = diff(r, remote, resid, dedupe_index)
+        if not has_changes(changes):
+            log('  up to date')
+            result['status'] = 'unchanged'
+            return result
+        describe(changes, log)
+        if dry_run:
+            result['status'] = 'changed'
+            return result
+
+        steps = build_sync_steps(hs, r, resid, changes, log,
+                                 dedupe_index=dedupe_index, **options)
+        for s in steps:
+            def timed(res, s=s, func=s.func):
+                with metrics.timed(s.name.split(':')[0], s.nbytes,
+                                   resource=key, name=s.name):
+                    return func(res)
+            s.func = timed
+        scheduler.run(steps, workers=step_workers)
+        log('  elapsed time %3.5f seconds' % (time.time() - st))
+        result['status'] = 'updated'
+        return result
+
+    except Exception as e:
+        log('\n  ERROR ENCOUNTERED: %s' % e)
+        result['status'] = 'failed'
+        result['message'] = e
+        return result
+
+
+def sync_many(hs, resources, resids, workers=1, max_inflight=None,
+              request_policy=None, **options):
+    """
+    Syncs each resource with the existing resource id found for it in
+    resids, a dict keyed by resource key, or given by the manifest.
+    Returns the results grouped by status: updated, changed (when
+    dry_run), unchanged, missing (no resource id) and failed.
+    """
+    if max_inflight is not None:
+        create.set_max_inflight(hs, max_inflight)
+    if request_policy is not None:
+        create.set_policy(hs, request_policy)
+
+    results = dict(updated=[], changed=[], unchanged=[], missing=[],
+                   failed=[])
+
+    def work(r):
+        key = r.sheet or r.title
+        resid = r.resid or resids.get(key)
+        if resid is None:
+            return {'id': None, 'key': key, 'title': r.title,
+                    'status': 'missing', 'message': None}
+        log = ResourceLog(buffered=workers > 1)
+        try:
+            return sync_resource(hs, r, resid, log, **options)
+        finally:
+            log.flush()
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = set()
+        for r in resources:
+            futures.add(pool.submit(work, r))
+            if len(futures) >= 2 * max(1, workers):
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    res = future.result()
+                    results[res['status']].append(res)
+        for future in futures:
+            res = future.result()
+            results[res['status']].append(res)
+    return results
+
+
+def report(results):
+    print('\n' + 50*'-')
+    print('Sync Summary')
+    print(50*'-')
+    for status in ('updated', 'changed', 'unchanged', 'missing', 'failed'):
+        if len(results[status]) > 0:
+            print('  %-10s %d' % (status, len(results[status])))
+    for res in results['missing']:
+        print('  %s: no existing resource id, not synced' % res['key'])
+    for res in results['failed']:
+        print('  %s: %s' % (res['title'], res['message']))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+"""
+Generates synthetic bulk upload templates for benchmarking.  Requires
+xlwt, since xlrd can only read workbooks.
+"""
+
+import os
+
+
+def write_template(path, nsheets, nfiles, files=None, nauthors=2):
+    """
+    Writes an .xls workbook in the layout of hs-template-0.1.xlsx with
+    nsheets resource sheets, each listing nfiles Resource Content rows.
+    files, if given, is a list of local paths cycled through to fill the
+    Resource Content section.  As in the template, one blank row
+    separates each section from the next header.
+    """
+    import xlwt
+
+    book = xlwt.Workbook()
+    book.add_sheet('__instructions').write(0, 0, 'Instructions')
+    for i in range(nsheets):
+        sheet = book.add_sheet('resource %d' % i)
+        row = [0]
+
+        def line(*cells):
+            for col, value in cells:
+                sheet.write(row[0], col, value)
+            row[0] += 1
+
+        line((0, 'Resource Metadata Template'))
+        line()
+        line((0, 'General Metadata'))
+        line((1, 'Value'))
+        line((0, 'Title'), (1, 'synthetic resource %d' % i))
+        line((0, 'Abstract'), (1, 'synthetic abstract %d' % i))
+        line((0, 'Keywords'), (1, 'synthetic benchmark'))
+        line((0, 'Type'), (1, 'CompositeResource'))
+        line((0, 'Sharing Status'), (1, 'private'))
+        line((0, 'Shareable'), (1, 1))
+        line()
+        line((0, 'Resource Content'))
+        line((0, 'Unique ID'), (1, 'Local Filepath'), (7, 'File Type'),
+             (9, 'Unzip'))
+        for j in range(nfiles):
+            fpath = files[j % len(files)] if files else \
+                os.path.join('data', 'file-%d-%d.csv' % (i, j))
+            line((0, j + 1), (1, fpath), (9, 0))
+        line()
+        line((0, 'File Metadata'))
+        line((1, 'Unique File ID'), (5, 'File Title'), (7, 'Start date'),
+             (8, 'End date'), (9, 'Location name'),
+             (11, 'Spatial Cov. Type'), (13, 'Spatial Definition'),
+             (17, 'Help'))
+        line()
+        line((0, 'Science Metadata'))
+        line((1, 'Name'), (3, 'Organization'), (5, 'Email'))
+        for j in range(nauthors):
+            line((0, 'Author %d' % (j + 1)), (1, 'Author %d' % j),
+                 (3, 'CUAHSI'), (5, 'author%d@example.com' % j))
+        line()
+        line((0, 'Resource Metadata'))
+        line((1, 'Key'), (3, 'Value'))
+        line((0, 'Custom 1'), (1, 'benchmark'), (3, 'synthetic'))
+    book.save(path)
+    return path
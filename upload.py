@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+
+import os
+import mmap
+import time
+import threading
+
+default_chunk_size = 8 * 1024 * 1024
+
+# files larger than this report their progress while uploading
+progress_size = 100 * 1024 * 1024
+
+# shared by every upload when a bandwidth limit has been set
+_bandwidth = None
+
+
+class BandwidthScheduler(object):
+    """
+    Shares a budget of rate bytes/second between every file being
+    uploaded.  Bytes are granted to the file that has been sent the
+    least so far, so files progress evenly and small or newly started
+    files are not stuck behind large ones.  While other (small, latency
+    sensitive) requests are in flight, uploads are held to
+    1 - headroom of the budget so those requests are not queued behind
+    upload data on the link.  The aggregate throughput is printed every
+    report_interval seconds while files are uploading.
+    """
+
+    def __init__(self, rate, headroom=0.1, burst=256 * 1024,
+                 report_interval=30):
+        self.rate = float(rate)
+        self.headroom = headroom
+        self.burst = burst
+        self.report_interval = report_interval
+        self.tokens = 0.
+        self.last = time.time()
+        self.sent = {}
+        self.waiting = []
+        self.urgent = 0
+        self.total = 0
+        self.cond = threading.Condition()
+        self._reporter = None
+
+    def _refill(self):
+        now = time.time()
+        rate = self.rate * (1 - self.headroom) if self.urgent else self.rate
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * rate)
+        self.last = now
+        return rate
+
+    def start(self, reader):
+        with self.cond:
+            self.sent[reader] = 0
+            if self._reporter is None and self.report_interval:
+                self._reporter = threading.Thread(target=self._report,
+                                                  daemon=True)
+                self._reporter.start()
+
+    def finish(self, reader):
+        with self.cond:
+            self.sent.pop(reader, None)
+            self.cond.notify_all()
+
+    def acquire(self, reader, n):
+        """
+        Blocks until reader may send n more bytes.
+        """
+        with self.cond:
+            self.waiting.append(reader)
+            try:
+                while True:
+                    rate = self._refill()
+                    first = min(self.waiting,
+                                key=lambda r: self.sent.get(r, 0))
+                    if first is reader and self.tokens > 0:
+                        # a grant larger than the tokens available is
+                        # paid back before the next one
+                        self.tokens -= n
+                        self.sent[reader] = self.sent.get(reader, 0) + n
+                        self.total += n
+                        return
+                    if first is reader:
+                        self.cond.wait(max(0.001, -self.tokens / rate))
+                    else:
+                        self.cond.wait()
+            finally:
+                self.waiting.remove(reader)
+                self.cond.notify_all()
+
+    def begin_request(self):
+        with self.cond:
+            self._refill()
+            self.urgent += 1
+
+    def end_request(self):
+        with self.cond:
+            self._refill()
+            self.urgent -= 1
+
+    def _report(self):
+        last_total = 0
+        last = time.time()
+        while True:
+            time.sleep(self.report_interval)
+            with self.cond:
+                total, nfiles = self.total, len(self.sent)
+            now = time.time()
+            if total > last_total:
+                # imported here, create imports this module
+                import create
+                with create._print_lock:
+                    print('  uploading %d files at %s/s (%s sent)'
+                          % (nfiles, format_bytes((total - last_total) /
+                                                  (now - last)),
+                             format_bytes(total)), flush=True)
+            last_total, last = total, now
+
+
+def set_bandwidth(rate, **options):
+    """
+    Limits all uploads together to rate bytes/second, or removes the
+    limit if rate is None.
+    """
+    global _bandwidth
+    _bandwidth = BandwidthScheduler(rate, **options) if rate else None
+
+
+def bandwidth():
+    return _bandwidth
+
+
+class ChunkedReader(object):
+    """
+    Read-only file-like object that serves a file from a memory map in
+    chunks of at most chunk_size bytes, so the upload never holds more
+    than one chunk of the file in memory.
+    """
+
+    def __init__(self, path, chunk_size=default_chunk_size, callback=None,
+                 scheduler=None):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.callback = callback
+        self.scheduler = scheduler
+        self.size = os.path.getsize(path)
+        self.pos = 0
+        self.start = None
+        self._fd = open(path, 'rb')
+        self._map = None
+        if self.size > 0:
+            self._map = mmap.mmap(self._fd.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.size - self.pos
+
+    def read(self, n=-1):
+        if self.start is None:
+            self.start = time.time()
+        if n is None or n < 0 or n > self.chunk_size:
+            n = self.chunk_size
+        end = min(self.pos + n, self.size)
+        if self.scheduler is not None and end > self.pos:
+            self.scheduler.acquire(self, end - self.pos)
+        data = self._map[self.pos:end] if self._map is not None else b''
+        self.pos = end
+        if self.callback is not None:
+            self.callback(self)
+        return data
+
+    def elapsed(self):
+        if self.start is None:
+            return 0.
+        return time.time() - self.start
+
+    def rate(self):
+        elapsed = self.elapsed()
+        return self.pos / elapsed if elapsed > 0 else 0.
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        self._fd.close()
+
+
+def format_bytes(n):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if n < 1024:
+            return '%.1f %s' % (n, unit)
+        n /= 1024.
+    return '%.1f TB' % n
+
+
+def upload_file(hs, resid, path, chunk_size=default_chunk_size, log=print):
+    """
+    Streams a file into a resource and returns the transfer rate in
+    bytes/second.  The HydroShare API has no ranged upload, so a failed
+    transfer has to be retried from the start of the file, which the
+    request policy does by calling this function again.
+    """
+    fname = os.path.basename(path)
+    reported = [0]
+
+    def progress(reader):
+        if reader.size < progress_size:
+            return
+        pct = int(100 * reader.pos / reader.size) // 10 * 10
+        if pct > reported[0]:
+            reported[0] = pct
+            log('    %s: %d%% (%s/s)' % (fname, pct,
+                                       format_bytes(reader.rate())))
+
+    scheduler = _bandwidth
+    reader = ChunkedReader(path, chunk_size, progress, scheduler)
+    if scheduler is not None:
+        scheduler.start(reader)
+    try:
+        hs.addResourceFile(resid, reader, resource_filename=fname)
+        return reader.rate()
+    finally:
+        if scheduler is not None:
+            scheduler.finish(reader)
+        reader.close()